@@ -6,11 +6,30 @@ from PIL import ImageGrab, ImageTk
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import threading
+import functools
+import http.server
+import os
 import logging
+import logging.handlers
+import queue
+import tempfile
+import sqlite3
+import cProfile
+import pstats
+import io
+import tracemalloc
+import zlib
+import csv
+import shutil
+import platform
 import sys
 from pathlib import Path
 from PIL import Image
 import re
+import json
+from collections import Counter, deque
+from datetime import datetime
+from contextlib import contextmanager
 from typing import Dict, List, Tuple, Optional
 
 from pywinauto.application import Application
@@ -21,15 +40,26 @@ from pywinauto.keyboard import send_keys
 class DebugImageViewer:
     """Ventana para mostrar imágenes de debugging en tiempo real"""
     
-    def __init__(self, parent_logger, parent_log_callback):
+    def __init__(self, parent_logger, parent_log_callback, max_fps=4):
         self.logger = parent_logger
         self.log_callback = parent_log_callback
         self.debug_window = None
         self.is_visible = False
         self.image_label = None
         self.info_label = None
-        self.current_image = None
+        self.current_image = None      # Captura BGR completa (referencia, sin copia) del último pedido
         self.current_template = None
+        self.current_request: Optional[Dict] = None
+        # Renderizado fuera del hilo de automatización: pedidos limitados a max_fps, en un solo buzón
+        self.min_interval = 1.0 / max_fps
+        self.last_request = 0.0
+        self.request_lock = threading.Lock()
+        self.pending_request: Optional[Dict] = None
+        self.request_event = threading.Event()
+        self.rendered: Optional[Tuple[Image.Image, str]] = None  # Listo para que Tk lo muestre
+        self.canvas_size = (780, 560)
+        self.show_template = True
+        self.render_thread: Optional[threading.Thread] = None
         
     def create_debug_window(self):
         """Crea la ventana de debugging"""
@@ -68,6 +98,7 @@ class DebugImageViewer:
         self.canvas.configure(yscrollcommand=v_scrollbar.set, xscrollcommand=h_scrollbar.set)
         
         self.canvas.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S))
+        self.canvas.bind("<Configure>", self.on_canvas_resize)
         v_scrollbar.grid(row=0, column=1, sticky=(tk.N, tk.S))
         h_scrollbar.grid(row=1, column=0, sticky=(tk.W, tk.E))
         
@@ -84,13 +115,17 @@ class DebugImageViewer:
         # Checkbox para mostrar template
         self.show_template_var = tk.BooleanVar(value=True)
         template_check = ttk.Checkbutton(controls_frame, text="Mostrar template", 
-                                       variable=self.show_template_var, command=self.update_display)
+                                       variable=self.show_template_var, command=self.on_show_template_changed)
         template_check.pack(side=tk.LEFT, padx=(5, 0))
         
         # Manejar cierre de ventana
         self.debug_window.protocol("WM_DELETE_WINDOW", self.hide_debug_window)
         
         self.is_visible = True
+        if self.render_thread is None:
+            self.render_thread = threading.Thread(target=self.render_loop, daemon=True)
+            self.render_thread.start()
+        self.debug_window.after(50, self.poll_rendered)
         
     def show_debug_window(self):
         """Muestra la ventana de debugging"""
@@ -105,100 +140,120 @@ class DebugImageViewer:
         if self.debug_window and self.debug_window.winfo_exists():
             self.debug_window.withdraw()
         self.is_visible = False
-        
-    def update_image(self, screenshot_pil, template_path=None, template_image=None, 
-                    search_result=None, step_info=""):
-        """Actualiza la imagen en la ventana de debugging"""
-        if not self.is_visible or not self.debug_window or not self.debug_window.winfo_exists():
+
+    def on_canvas_resize(self, event):
+        self.canvas_size = (max(event.width, 50), max(event.height, 50))
+        self.request_render()
+
+    def on_show_template_changed(self):
+        self.show_template = self.show_template_var.get()
+        self.request_render()
+
+    def update_image(self, screenshot_bgr, template_path=None, template_image=None,
+                     search_result=None, step_info="", best_match=None):
+        """Pide mostrar una captura (desde el hilo de automatización). Solo guarda referencias:
+        descarta pedidos por encima de max_fps y el dibujo se hace en el hilo de renderizado.
+        best_match: (top_left relativo, score) del mejor intento, aunque no alcance el umbral"""
+        if not self.is_visible:
             return
-            
-        try:
-            self.current_image = screenshot_pil.copy()
-            self.current_template = template_image
-            
-            # Información del paso actual
-            info_text = f"Paso: {step_info}"
-            if template_path:
-                info_text += f" | Template: {template_path}"
-            if search_result:
-                info_text += f" | Encontrado en: {search_result}"
-            else:
-                info_text += " | Template NO encontrado"
-                
-            self.info_label.config(text=info_text)
-            
-            self.update_display()
-            
-        except Exception as e:
-            self.logger.error(f"Error actualizando imagen debug: {e}")
-    
-    def update_display(self):
-        """Actualiza la visualización combinando screenshot y template"""
-        if not self.current_image:
+        now = time.monotonic()
+        if now - self.last_request < self.min_interval:
             return
-            
-        try:
-            display_image = self.current_image.copy()
-            
-            # Si hay template y está habilitado, combinarlo
-            if (self.current_template is not None and 
-                self.show_template_var.get()):
-                
-                # Convertir template de OpenCV a PIL
-                template_rgb = cv2.cvtColor(self.current_template, cv2.COLOR_BGR2RGB)
-                template_pil = Image.fromarray(template_rgb)
-                
-                # Crear imagen combinada
-                combined_width = display_image.width + template_pil.width + 20
-                combined_height = max(display_image.height, template_pil.height) + 40
-                
-                combined_image = Image.new('RGB', (combined_width, combined_height), 'white')
-                
-                # Pegar screenshot
-                combined_image.paste(display_image, (0, 20))
-                
-                # Pegar template
-                combined_image.paste(template_pil, (display_image.width + 20, 20))
-                
-                # Añadir etiquetas
-                from PIL import ImageDraw, ImageFont
-                draw = ImageDraw.Draw(combined_image)
-                try:
-                    font = ImageFont.truetype("arial.ttf", 14)
-                except:
-                    font = ImageFont.load_default()
-                
-                draw.text((10, 0), "Screenshot", fill='black', font=font)
-                draw.text((display_image.width + 30, 0), "Template", fill='black', font=font)
-                
-                display_image = combined_image
-            
-            # Redimensionar si es muy grande
-            max_display_size = (1200, 800)
-            if (display_image.width > max_display_size[0] or 
-                display_image.height > max_display_size[1]):
-                display_image.thumbnail(max_display_size, Image.Resampling.LANCZOS)
-            
-            # Convertir a PhotoImage para tkinter
-            self.photo = ImageTk.PhotoImage(display_image)
-            
-            # Actualizar canvas
-            self.canvas.delete("all")
-            self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
-            self.canvas.configure(scrollregion=self.canvas.bbox("all"))
-            
-        except Exception as e:
-            self.logger.error(f"Error actualizando display: {e}")
-    
+        self.last_request = now
+
+        info_text = f"Paso: {step_info}"
+        if template_path:
+            info_text += f" | Template: {template_path}"
+        if search_result:
+            info_text += f" | Encontrado en: {search_result}"
+        else:
+            info_text += " | Template NO encontrado"
+        if best_match is not None and best_match[1] == best_match[1]:  # NaN: sin score
+            info_text += f" | Score: {best_match[1]:.3f}"
+
+        self.current_image = screenshot_bgr
+        self.current_template = template_image
+        self.current_request = {'screenshot': screenshot_bgr, 'template': template_image, 'info': info_text,
+                                'found': search_result is not None, 'best_match': best_match}
+        self.request_render()
+
+    def request_render(self):
+        if self.current_request is None:
+            return
+        with self.request_lock:
+            self.pending_request = self.current_request
+        self.request_event.set()
+
+    def render_loop(self):
+        """Hilo de renderizado: toma siempre el último pedido (los intermedios se descartan)"""
+        while True:
+            self.request_event.wait()
+            with self.request_lock:
+                request, self.pending_request = self.pending_request, None
+                self.request_event.clear()
+            if request is None:
+                continue
+            try:
+                self.rendered = (self.render(request), request['info'])
+            except Exception as e:
+                self.logger.error(f"Error actualizando display: {e}")
+
+    def render(self, request) -> Image.Image:
+        """Reduce la captura al tamaño del canvas (INTER_AREA), marca la coincidencia y agrega el template"""
+        screenshot = request['screenshot']
+        template = request['template'] if self.show_template else None
+        canvas_w, canvas_h = self.canvas_size
+        if template is not None:
+            canvas_w -= template.shape[1] + 20
+        scale = min(1.0, canvas_w / screenshot.shape[1], canvas_h / screenshot.shape[0])
+        size = (max(1, int(screenshot.shape[1] * scale)), max(1, int(screenshot.shape[0] * scale)))
+        display = cv2.resize(screenshot, size, interpolation=cv2.INTER_AREA) if scale < 1.0 else screenshot.copy()
+
+        best_match = request['best_match']
+        if best_match is not None and best_match[0] is not None and request['template'] is not None:
+            (x, y), score = best_match
+            h, w = request['template'].shape[:2]
+            color = (0, 200, 0) if request['found'] else (0, 0, 255)
+            top_left = (int(x * scale), int(y * scale))
+            cv2.rectangle(display, top_left, (int((x + w) * scale), int((y + h) * scale)), color, 2)
+            if score == score:
+                cv2.putText(display, f"{score:.3f}", (top_left[0], max(12, top_left[1] - 4)),
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1, cv2.LINE_AA)
+
+        if template is not None:
+            combined = np.full((max(display.shape[0], template.shape[0]), display.shape[1] + template.shape[1] + 20, 3),
+                               255, np.uint8)
+            combined[:display.shape[0], :display.shape[1]] = display
+            combined[:template.shape[0], display.shape[1] + 20:] = template
+            display = combined
+        return Image.fromarray(cv2.cvtColor(display, cv2.COLOR_BGR2RGB))
+
+    def poll_rendered(self):
+        """Hilo de Tk: muestra la última imagen renderizada"""
+        if not self.debug_window or not self.debug_window.winfo_exists():
+            return
+        rendered, self.rendered = self.rendered, None
+        if rendered is not None:
+            image, info_text = rendered
+            try:
+                self.info_label.config(text=info_text)
+                self.photo = ImageTk.PhotoImage(image)
+                self.canvas.delete("all")
+                self.canvas.create_image(0, 0, anchor=tk.NW, image=self.photo)
+                self.canvas.configure(scrollregion=self.canvas.bbox("all"))
+            except Exception as e:
+                self.logger.error(f"Error actualizando display: {e}")
+        self.debug_window.after(50, self.poll_rendered)
+
     def save_current_image(self):
         """Guarda la imagen actual"""
-        if not self.current_image:
+        if self.current_image is None:
             return
             
         try:
             timestamp = time.strftime("%Y%m%d_%H%M%S")
             filename = f"debug_screenshot_{timestamp}.png"
-            self.current_image.save(filename)
+            Image.fromarray(cv2.cvtColor(self.current_image, cv2.COLOR_BGR2RGB)).save(filename)
             self.log_callback(f"Imagen guardada: {filename}")
         except Exception as e:
             self.logger.error(f"Error guardando imagen: {e}")
@@ -209,6 +264,1890 @@ class DebugImageViewer:
         self.info_label.config(text="Sin imagen")
         self.current_image = None
         self.current_template = None
+        self.current_request = None
+
+class CapturedFrame:
+    """Captura única del escritorio que cubre la unión de varias ventanas"""
+
+    def __init__(self, pixels: np.ndarray, origin: Tuple[int, int], timestamp: float, frame_id: int = 0):
+        self.pixels = pixels      # Imagen BGR (alto, ancho, 3)
+        self.frame_id = frame_id  # Identificador único de la captura (para cachés por frame)
+        self.origin = origin      # Esquina superior izquierda en coordenadas absolutas
+        self.timestamp = timestamp
+
+    def covers(self, bbox) -> bool:
+        """Indica si la captura contiene completamente el bbox dado"""
+        left, top = self.origin
+        height, width = self.pixels.shape[:2]
+        return (bbox[0] >= left and bbox[1] >= top and
+                bbox[2] <= left + width and bbox[3] <= top + height)
+
+    def view(self, bbox) -> np.ndarray:
+        """Devuelve la región del bbox como vista NumPy (sin copia)"""
+        x0 = bbox[0] - self.origin[0]
+        y0 = bbox[1] - self.origin[1]
+        return self.pixels[y0:y0 + (bbox[3] - bbox[1]), x0:x0 + (bbox[2] - bbox[0])]
+
+
+class MetricsRegistry:
+    """Contadores, gauges e histogramas con etiquetas, en formato de texto de Prometheus"""
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.metrics: Dict[str, Dict] = {}  # nombre -> {tipo, ayuda, buckets, series}
+        self.callbacks: Dict[str, Tuple[str, str, object]] = {}  # nombre -> (tipo, ayuda, función)
+        self._lock = threading.Lock()
+
+    def _series(self, name, kind, help_text, labels, buckets=None):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = {'type': kind, 'help': help_text, 'series': {},
+                                           'buckets': tuple(buckets or self.DEFAULT_BUCKETS)}
+        key = tuple(sorted(labels.items()))
+        series = metric['series'].get(key)
+        if series is None:
+            series = metric['series'][key] = ([0] * (len(metric['buckets']) + 1) + [0.0]
+                                              if kind == 'histogram' else [0.0])
+        return metric, series
+
+    def inc(self, name, value=1.0, help_text="", **labels):
+        with self._lock:
+            self._series(name, 'counter', help_text, labels)[1][0] += value
+
+    def set(self, name, value, help_text="", **labels):
+        with self._lock:
+            self._series(name, 'gauge', help_text, labels)[1][0] = value
+
+    def observe(self, name, value, help_text="", buckets=None, **labels):
+        """Histograma: series = conteos por bucket (el último es +Inf) y la suma al final"""
+        with self._lock:
+            metric, series = self._series(name, 'histogram', help_text, labels, buckets)
+            for i, bound in enumerate(metric['buckets']):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(metric['buckets'])] += 1
+            series[-1] += value
+
+    def register_callback(self, name, kind, help_text, function):
+        """Métrica calculada al exportar (por ejemplo, CPU del proceso)"""
+        self.callbacks[name] = (kind, help_text, function)
+
+    def value(self, name, **labels) -> float:
+        """Valor de un contador/gauge, o cantidad de observaciones de un histograma"""
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                return 0.0
+            series = metric['series'].get(tuple(sorted(labels.items())))
+            if series is None:
+                return 0.0
+            return float(sum(series[:-1])) if metric['type'] == 'histogram' else series[0]
+
+    def histogram_totals(self, name) -> Tuple[int, float]:
+        """(observaciones, suma) de todas las series del histograma"""
+        with self._lock:
+            metric = self.metrics.get(name, {'series': {}})
+            return (sum(sum(series[:-1]) for series in metric['series'].values()),
+                    sum(series[-1] for series in metric['series'].values()))
+
+    @staticmethod
+    def _labels(key, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text, function) in self.callbacks.items():
+            try:
+                value = function()
+            except Exception:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        with self._lock:
+            for name, metric in self.metrics.items():
+                lines += [f"# HELP {name} {metric['help']}", f"# TYPE {name} {metric['type']}"]
+                for key, series in metric['series'].items():
+                    if metric['type'] != 'histogram':
+                        lines.append(f"{name}{self._labels(key)} {series[0]}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(metric['buckets'] + ('+Inf',), series[:-1]):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(key)} {series[-1]}")
+                    lines.append(f"{name}_count{self._labels(key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Expone el registro en http://127.0.0.1:<puerto>/metrics (hilo propio, sin servicios externos)"""
+
+    def __init__(self, logger, registry: MetricsRegistry, port=9464):
+        self.logger = logger
+        self.registry = registry
+        self.port = port
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # Sin una línea de log por cada scrape
+
+        try:
+            self.server = http.server.ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        except OSError as e:
+            self.logger.warning(f"No se pudo abrir el endpoint de métricas en el puerto {self.port}: {e}")
+            return False
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info(f"Métricas en http://127.0.0.1:{self.port}/metrics")
+        return True
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class RateSampler:
+    """Tasa por segundo de un valor acumulado, medida en ventanas de al menos min_interval segundos"""
+
+    def __init__(self, function, min_interval=1.0):
+        self.function = function
+        self.min_interval = min_interval
+        self.last_time = time.monotonic()
+        self.last_value = function()
+        self.rate = 0.0
+
+    def __call__(self) -> float:
+        now = time.monotonic()
+        if now - self.last_time >= self.min_interval:
+            value = self.function()
+            self.rate = (value - self.last_value) / (now - self.last_time)
+            self.last_time, self.last_value = now, value
+        return self.rate
+
+
+def timed(metric_name, help_text=""):
+    """Decorador de métodos de MonacoBot: observa la duración de la llamada en un histograma"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.observe(metric_name, time.perf_counter() - start, help_text)
+        return wrapper
+    return decorator
+
+
+class _NullSpan:
+    """Span vacío para cuando el trazado está apagado (sin costo más allá de la llamada)"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.add(self.name, self.category, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class SpanTracer:
+    """Spans anidados de tiempo por hilo, exportables como traza de Chrome/Perfetto (chrome://tracing)"""
+
+    def __init__(self, max_events=200000):
+        self.enabled = False
+        self.max_events = max_events
+        self.events: List[Dict] = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self.events = []
+            self.origin = time.perf_counter()
+        self.enabled = True
+
+    def span(self, name, category="bot", **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, args)
+
+    def add(self, name, category, start, end, args):
+        event = {"name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": round((start - self.origin) * 1e6, 1), "dur": round((end - start) * 1e6, 1)}
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+        with self._lock:
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+
+    def export(self, path: Path):
+        """Escribe la traza en formato JSON de Chrome y apaga el trazado"""
+        self.enabled = False
+        with self._lock:
+            events = sorted(self.events, key=lambda event: event["ts"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), encoding="utf-8")
+        return len(events)
+
+
+def traced(name):
+    """Decorador de métodos de MonacoBot: envuelve la llamada en un span (arg = primer argumento)"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if not self.tracer.enabled:
+                return method(self, *args, **kwargs)
+            with self.tracer.span(name, arg=args[0] if args else ""):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class FrameGrabber:
+    """Hace una sola captura por tick (unión de bboxes) y entrega vistas por ventana"""
+
+    def __init__(self, logger, max_age=0.5, tracer=None, metrics=None, recorder=None):
+        self.logger = logger
+        self.max_age = max_age  # Segundos que una captura sigue siendo válida sin nuevo tick
+        self.tracer = tracer or SpanTracer()
+        self.metrics = metrics or MetricsRegistry()
+        self.recorder = recorder
+        self.current_frame: Optional[CapturedFrame] = None
+        self.pending_regions: List[Tuple[int, int, int, int]] = []
+        self.capture_count = 0
+        self.frame_serial = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def union_bbox(bboxes) -> Tuple[int, int, int, int]:
+        """Calcula el bbox que contiene a todos los bboxes dados"""
+        return (min(b[0] for b in bboxes), min(b[1] for b in bboxes),
+                max(b[2] for b in bboxes), max(b[3] for b in bboxes))
+
+    @staticmethod
+    def to_absolute(window_bbox, pos_rel) -> Tuple[int, int]:
+        """Convierte una posición relativa a la ventana en coordenadas de pantalla"""
+        return (int(window_bbox[0] + pos_rel[0]), int(window_bbox[1] + pos_rel[1]))
+
+    def new_tick(self, bboxes=None):
+        """Descarta la captura anterior y declara las regiones del nuevo tick"""
+        with self._lock:
+            self.current_frame = None
+            self.pending_regions = [tuple(b) for b in (bboxes or []) if b]
+
+    def declare_regions(self, bboxes):
+        """Agrega regiones al tick actual para que entren en la próxima captura"""
+        with self._lock:
+            self.pending_regions.extend(tuple(b) for b in bboxes if b)
+
+    def invalidate(self):
+        """Fuerza una nueva captura (por ejemplo después de un clic)"""
+        with self._lock:
+            self.current_frame = None
+
+    def get_region(self, bbox) -> np.ndarray:
+        """Devuelve la vista de la región, capturando la unión del tick solo si hace falta"""
+        return self.get_frame_region(bbox)[1]
+
+    def get_frame_region(self, bbox) -> Tuple[CapturedFrame, np.ndarray]:
+        """Como get_region, pero devuelve también la captura de la que sale la vista (para su frame_id)"""
+        bbox = tuple(bbox)
+        with self._lock:
+            frame = self.current_frame
+            if (frame is None or not frame.covers(bbox) or
+                    time.time() - frame.timestamp > self.max_age):
+                frame = self._grab(self.pending_regions + [bbox])
+            return frame, frame.view(bbox)
+
+    def _grab(self, bboxes) -> CapturedFrame:
+        """Captura la unión de los bboxes en una sola llamada a ImageGrab"""
+        union = self.union_bbox(bboxes)
+        start = time.perf_counter()
+        with self.tracer.span("captura", "captura", bbox=union):
+            screenshot = ImageGrab.grab(bbox=union)
+            pixels = cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR)
+        self.metrics.observe("monaco_bot_capture_seconds", time.perf_counter() - start, "Duración de cada captura")
+        self.metrics.inc("monaco_bot_captures_total", help_text="Capturas de pantalla")
+        self.frame_serial += 1
+        self.current_frame = CapturedFrame(pixels, (union[0], union[1]), time.time(), self.frame_serial)
+        self.pending_regions = [union]
+        self.capture_count += 1
+        if self.recorder is not None:
+            self.recorder.add(self.current_frame)
+        return self.current_frame
+
+
+class FlightRecorder:
+    """Grabador de vuelo: las últimas capturas en memoria, codificadas como diferencia (XOR + zlib) con la
+    anterior, para volcarlas a disco con sus coincidencias cuando un paso falla o se pide"""
+
+    def __init__(self, logger, log_callback, telemetry=None, minutes=5.0, max_bytes=256 * 1024 * 1024,
+                 keyframe_interval=60, output_dir=Path("logs"), max_dumps=5, max_dump_bytes=1024 * 1024 * 1024):
+        self.logger = logger
+        self.log_callback = log_callback
+        self.telemetry = telemetry
+        self.max_age = minutes * 60
+        self.max_bytes = max_bytes
+        self.keyframe_interval = keyframe_interval  # Limita cuántas diferencias hay que aplicar al decodificar
+        self.output_dir = output_dir
+        # Cada volcado puede ocupar cientos de MB: se conservan pocos y se borran los más viejos
+        self.max_dumps = max_dumps
+        self.max_dump_bytes = max_dump_bytes
+        self.enabled = False
+        self.step = ""
+        # Tramos: cada uno empieza con un frame completo seguido de diferencias
+        self.segments: deque = deque()
+        self.total_bytes = 0
+        self.dropped = 0
+        self.previous: Optional[CapturedFrame] = None
+        self.pending: queue.Queue = queue.Queue(maxsize=8)
+        self.dump_thread: Optional[threading.Thread] = None
+        self._dump_lock = threading.Lock()  # dump() se llama desde Tk (botón) y desde la automatización
+        self._lock = threading.Lock()
+        self._encoder = threading.Thread(target=self.encode_loop, daemon=True)
+        self._encoder.start()
+
+    def add(self, frame: CapturedFrame):
+        """Hilo de automatización: solo encola la referencia (las capturas no se modifican)"""
+        if not self.enabled:
+            return
+        try:
+            self.pending.put_nowait((frame, self.step))
+        except queue.Full:
+            self.dropped += 1
+
+    def encode_loop(self):
+        while True:
+            frame, step = self.pending.get()
+            try:
+                self.encode(frame, step)
+            except Exception as e:
+                self.logger.error(f"Error codificando captura para el grabador: {e}")
+
+    def encode(self, frame: CapturedFrame, step):
+        previous = self.previous
+        keyframe = (previous is None or previous.pixels.shape != frame.pixels.shape or
+                    previous.origin != frame.origin or len(self.segments[-1]) >= self.keyframe_interval)
+        pixels = frame.pixels if keyframe else cv2.bitwise_xor(frame.pixels, previous.pixels)
+        entry = {'frame_id': frame.frame_id, 'timestamp': frame.timestamp, 'origin': frame.origin,
+                 'shape': frame.pixels.shape, 'step': step, 'data': zlib.compress(pixels.tobytes(), 1)}
+        self.previous = frame
+        with self._lock:
+            if keyframe:
+                self.segments.append([])
+            self.segments[-1].append(entry)
+            self.total_bytes += len(entry['data'])
+            # Se descartan tramos completos (el más viejo), nunca el que se está grabando
+            cutoff = frame.timestamp - self.max_age
+            while len(self.segments) > 1 and (self.total_bytes > self.max_bytes or
+                                              self.segments[0][-1]['timestamp'] < cutoff):
+                self.total_bytes -= sum(len(e['data']) for e in self.segments.popleft())
+
+    @staticmethod
+    def decode(segments):
+        """Genera (entrada, imagen BGR) en orden cronológico"""
+        for segment in segments:
+            pixels = None
+            for entry in segment:
+                data = np.frombuffer(zlib.decompress(entry['data']), np.uint8).reshape(entry['shape'])
+                pixels = data if pixels is None else cv2.bitwise_xor(pixels, data)
+                yield entry, pixels
+
+    def frame_count(self) -> int:
+        with self._lock:
+            return sum(len(segment) for segment in self.segments)
+
+    def dump(self, reason) -> Optional[Path]:
+        """Vuelca el buffer en un hilo aparte; devuelve la carpeta destino (None si ya hay un volcado en curso)"""
+        with self._dump_lock:
+            if self.dump_thread is not None and self.dump_thread.is_alive():
+                self.logger.warning(f"Grabador de vuelo: volcado en curso, se omite ({reason})")
+                return None
+            with self._lock:
+                segments = [list(segment) for segment in self.segments]
+            if not segments:
+                return None
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", reason).strip("_")[:40]
+            directory = self.output_dir / f"vuelo_{time.strftime('%Y%m%d_%H%M%S')}_{slug}"
+            self.dump_thread = threading.Thread(target=self.write, args=(directory, segments, reason), daemon=True)
+            self.dump_thread.start()
+        return directory
+
+    def prune_dumps(self):
+        """Deja como máximo max_dumps volcados y max_dump_bytes en disco, borrando los más viejos"""
+        dumps = sorted((d for d in self.output_dir.glob("vuelo_*") if d.is_dir()), key=lambda d: d.stat().st_mtime)
+        sizes = [sum(f.stat().st_size for f in d.iterdir() if f.is_file()) for d in dumps]
+        total = sum(sizes)
+        while dumps and (len(dumps) > self.max_dumps or total > self.max_dump_bytes):
+            oldest = dumps.pop(0)
+            total -= sizes.pop(0)
+            shutil.rmtree(oldest, ignore_errors=True)
+            self.logger.info(f"Grabador de vuelo: volcado viejo borrado {oldest}")
+
+    def write(self, directory: Path, segments, reason):
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            frame_ids = set()
+            with open(directory / "frames.csv", "w", encoding="utf-8", newline="") as f:
+                index = csv.writer(f)
+                index.writerow(["archivo", "frame", "time", "x", "y", "paso"])
+                for i, (entry, pixels) in enumerate(self.decode(segments)):
+                    name = f"{i:04d}_{entry['frame_id']}.png"
+                    ok, png = cv2.imencode(".png", pixels, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                    if ok:
+                        (directory / name).write_bytes(png.tobytes())
+                    frame_ids.add(entry['frame_id'])
+                    index.writerow([name, entry['frame_id'], f"{entry['timestamp']:.3f}", entry['origin'][0],
+                                    entry['origin'][1], entry['step']])
+            if self.telemetry is not None:
+                self.write_matches(directory / "coincidencias.csv", frame_ids)
+            (directory / "motivo.txt").write_text(reason + "\n", encoding="utf-8")
+            self.log_callback(f"Grabador de vuelo: {len(frame_ids)} capturas guardadas en {directory}")
+        except Exception as e:
+            self.logger.error(f"Error volcando grabador de vuelo: {e}")
+        try:
+            self.prune_dumps()
+        except Exception as e:
+            self.logger.error(f"Error borrando volcados viejos del grabador de vuelo: {e}")
+
+    def write_matches(self, path: Path, frame_ids):
+        """Búsquedas de template hechas sobre las capturas volcadas"""
+        columns = self.telemetry.columns()
+        keep = np.isin(columns['frame'], np.fromiter(frame_ids, np.int64, len(frame_ids)))
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(MatchTelemetry.DTYPE.names)
+            for values in zip(*(columns[name][keep] for name in MatchTelemetry.DTYPE.names)):
+                writer.writerow(f"{v:.4f}" if isinstance(v, (float, np.floating)) else v for v in values)
+
+
+class WindowGeometryTracker:
+    """Mantiene en caché el bbox de cada ventana objetivo y avisa solo cuando cambia"""
+
+    EVENT_OBJECT_LOCATIONCHANGE = 0x800B
+    OBJID_WINDOW = 0
+    WM_QUIT = 0x0012
+    WM_APP_HOOK = 0x8000 + 1  # Pide al hilo del hook que instale hooks para procesos nuevos
+    WINEVENT_SKIPOWNPROCESS = 0x0002
+
+    def __init__(self, logger, log_callback, check_interval=2.0):
+        self.logger = logger
+        self.log_callback = log_callback
+        self.check_interval = check_interval  # Revalidación de respaldo a baja frecuencia
+        self.targets: Dict[int, Dict] = {}
+        self.listeners = []
+        self._lock = threading.Lock()
+        self._hook_thread = None
+        self._hook_thread_id = None
+        self.hook_pids = set()  # Procesos a escuchar (el hook no es global: solo los de Monaco)
+
+    @staticmethod
+    def process_id(handle) -> int:
+        """Proceso dueño de la ventana (0 si no se pudo obtener)"""
+        if sys.platform != 'win32':
+            return 0
+        import ctypes
+        from ctypes import wintypes
+        pid = wintypes.DWORD(0)
+        ctypes.windll.user32.GetWindowThreadProcessId(handle, ctypes.byref(pid))
+        return pid.value
+
+    def track(self, window) -> Tuple[int, int, int, int]:
+        """Empieza a seguir una ventana y devuelve su bbox actual"""
+        rect = window.rectangle()
+        bbox = (rect.left, rect.top, rect.right, rect.bottom)
+        with self._lock:
+            self.targets[window.handle] = {
+                'window': window,
+                'bbox': bbox,
+                'last_check': time.time(),
+                'stale': False,
+            }
+            pid = self.process_id(window.handle)
+            new_pid = pid and pid not in self.hook_pids
+            if new_pid:
+                self.hook_pids.add(pid)
+        self.start_event_hook()
+        if new_pid and self._hook_thread_id:
+            import ctypes
+            ctypes.windll.user32.PostThreadMessageW(self._hook_thread_id, self.WM_APP_HOOK, 0, 0)
+        return bbox
+
+    def add_listener(self, callback):
+        """Registra callback(handle, bbox_anterior, bbox_nuevo) para invalidar cachés"""
+        self.listeners.append(callback)
+
+    def mark_stale(self, handle):
+        """Marca la ventana para revalidar su geometría en la próxima consulta"""
+        entry = self.targets.get(handle)
+        if entry:
+            entry['stale'] = True
+
+    def bbox(self, window, default=None):
+        """Devuelve el bbox en caché, revalidándolo solo si hubo evento o venció el intervalo"""
+        entry = self.targets.get(getattr(window, 'handle', window))
+        if entry is None:
+            return default
+        if entry['stale'] or time.time() - entry['last_check'] >= self.check_interval:
+            self._revalidate(entry)
+        return entry['bbox']
+
+    def _revalidate(self, entry):
+        """Lee el rectángulo actual (llamada barata) y notifica si cambió"""
+        entry['last_check'] = time.time()
+        entry['stale'] = False
+        try:
+            rect = entry['window'].rectangle()
+        except Exception as e:
+            self.logger.error(f"Error leyendo geometría de ventana: {e}")
+            return
+        new_bbox = (rect.left, rect.top, rect.right, rect.bottom)
+        old_bbox = entry['bbox']
+        if new_bbox == old_bbox:
+            return
+
+        entry['bbox'] = new_bbox
+        self.log_callback(f"Geometría de ventana cambió: {old_bbox} -> {new_bbox}")
+        for callback in self.listeners:
+            try:
+                callback(entry['window'].handle, old_bbox, new_bbox)
+            except Exception as e:
+                self.logger.error(f"Error invalidando cachés por cambio de geometría: {e}")
+
+    def start_event_hook(self):
+        """Escucha EVENT_OBJECT_LOCATIONCHANGE para revalidar apenas se mueve la ventana"""
+        if self._hook_thread or sys.platform != 'win32':
+            return
+        self._hook_thread = threading.Thread(target=self._event_loop, daemon=True)
+        self._hook_thread.start()
+
+    def stop_event_hook(self):
+        """Termina el hilo del hook de eventos"""
+        if self._hook_thread_id:
+            import ctypes
+            ctypes.windll.user32.PostThreadMessageW(self._hook_thread_id, self.WM_QUIT, 0, 0)
+        self._hook_thread = None
+        self._hook_thread_id = None
+
+    def _event_loop(self):
+        """Bucle de mensajes del hook (el callback solo marca la ventana como desactualizada)"""
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            user32 = ctypes.windll.user32
+            WinEventProc = ctypes.WINFUNCTYPE(
+                None, wintypes.HANDLE, wintypes.DWORD, wintypes.HWND,
+                wintypes.LONG, wintypes.LONG, wintypes.DWORD, wintypes.DWORD)
+
+            def on_event(hook, event, hwnd, id_object, id_child, thread, timestamp):
+                if id_object == self.OBJID_WINDOW and hwnd in self.targets:
+                    self.mark_stale(hwnd)
+
+            proc = WinEventProc(on_event)
+            hooks: Dict[int, int] = {}
+
+            def install_hooks():
+                # Un hook por proceso de Monaco: los eventos del resto del escritorio (cursor,
+                # caret, otras aplicaciones) no llegan a Python ni compiten por el GIL
+                with self._lock:
+                    pids = [pid for pid in self.hook_pids if pid not in hooks]
+                for pid in pids:
+                    hook = user32.SetWinEventHook(self.EVENT_OBJECT_LOCATIONCHANGE,
+                                                  self.EVENT_OBJECT_LOCATIONCHANGE,
+                                                  0, proc, pid, 0, self.WINEVENT_SKIPOWNPROCESS)
+                    if hook:
+                        hooks[pid] = hook
+                    else:
+                        self.logger.error(f"No se pudo instalar el hook de eventos de ventana (proceso {pid})")
+
+            # El id del hilo va antes de instalar: un track() posterior lo avisa por mensaje
+            self._hook_thread_id = ctypes.windll.kernel32.GetCurrentThreadId()
+            install_hooks()
+
+            msg = wintypes.MSG()
+            while user32.GetMessageW(ctypes.byref(msg), 0, 0, 0) > 0:
+                if msg.message == self.WM_APP_HOOK:
+                    install_hooks()
+                    continue
+                user32.TranslateMessage(ctypes.byref(msg))
+                user32.DispatchMessageW(ctypes.byref(msg))
+            for hook in hooks.values():
+                user32.UnhookWinEvent(hook)
+        except Exception as e:
+            self.logger.error(f"Error en hook de eventos de ventana: {e}")
+
+
+class TargetWindow:
+    """Ventana objetivo con nombre propio, conexión, templates y región de captura"""
+
+    def __init__(self, name, title_substring, templates=(), capture_region=None, fallback=None):
+        self.name = name
+        self.title_substring = title_substring
+        self.templates = set(templates)
+        # Región de captura en fracciones de la ventana (izq, arriba, der, abajo); None = completa
+        self.capture_region = capture_region
+        self.fallback = fallback  # Ventana a usar mientras esta no esté abierta
+        self.window = None
+        self.last_connect_attempt = 0.0
+
+
+class WindowRegistry:
+    """Registro de ventanas objetivo de Monaco (principal, consola de optimización, etc.)"""
+
+    def __init__(self, logger, log_callback, geometry_tracker, retry_interval=2.0):
+        self.logger = logger
+        self.log_callback = log_callback
+        self.geometry_tracker = geometry_tracker
+        self.retry_interval = retry_interval  # Evita buscar la ventana en cada poll
+        self.targets: Dict[str, TargetWindow] = {}
+        self.process_ids = set()  # Procesos de Monaco (los de las ventanas conectadas alguna vez)
+        self._using_fallback = set()
+
+    def register(self, target: TargetWindow):
+        """Agrega (o reemplaza) una ventana objetivo"""
+        self.targets[target.name] = target
+
+    def attach(self, name, window):
+        """Asocia una ventana ya conectada a un objetivo registrado"""
+        target = self.targets[name]
+        target.window = window
+        self.process_ids.add(WindowGeometryTracker.process_id(window.handle))
+        self.process_ids.discard(0)
+        self.geometry_tracker.track(window)
+
+    def handles(self) -> List[int]:
+        """Handles de todas las ventanas objetivo conectadas"""
+        return [t.window.handle for t in self.targets.values() if t.window is not None]
+
+    def is_fallback(self, name) -> bool:
+        """Indica si el objetivo se está resolviendo con su ventana de respaldo"""
+        return name in self._using_fallback
+
+    def target_for_template(self, template_name, default="main") -> str:
+        """Nombre de la ventana cuyo set de templates contiene al template dado"""
+        for target in self.targets.values():
+            if template_name in target.templates:
+                return target.name
+        return default
+
+    def connect(self, name):
+        """Devuelve la ventana conectada del objetivo, reconectando como mucho cada retry_interval"""
+        target = self.targets[name]
+        if target.window is not None:
+            try:
+                if target.window.is_visible():
+                    return target.window
+            except Exception:
+                pass
+            target.window = None
+
+        now = time.time()
+        if now - target.last_connect_attempt < self.retry_interval:
+            return None
+        target.last_connect_attempt = now
+
+        try:
+            # Solo ventanas del proceso de Monaco: otra aplicación con el mismo texto en el título
+            # (navegador, PDF, explorador) no puede pasar por la consola
+            if not self.process_ids:
+                return None
+            connected = self.handles()
+            title_re = f".*{re.escape(target.title_substring)}.*"
+            handles = [h for pid in sorted(self.process_ids)
+                       for h in find_windows(title_re=title_re, visible_only=True, process=pid)
+                       if h not in connected]
+            if not handles:
+                return None
+            app = Application().connect(handle=handles[0])
+            self.attach(name, app.window(handle=handles[0]))
+            self.log_callback(f"Ventana '{name}' conectada: {target.title_substring}")
+            return target.window
+        except Exception as e:
+            self.logger.error(f"Error conectando ventana '{name}': {e}")
+            return None
+
+    def resolve(self, name):
+        """Devuelve (ventana, bbox de captura) del objetivo, o de su respaldo si no está abierto"""
+        target = self.targets[name]
+        window = self.connect(name)
+        if window is None:
+            if target.fallback:
+                if name not in self._using_fallback:
+                    self._using_fallback.add(name)
+                    self.log_callback(f"Ventana '{name}' no disponible, usando '{target.fallback}'")
+                return self.resolve(target.fallback)
+            return None, None
+
+        self._using_fallback.discard(name)
+        bbox = self.geometry_tracker.bbox(window)
+        return window, self.capture_bbox(target, bbox)
+
+    @staticmethod
+    def capture_bbox(target: TargetWindow, bbox):
+        """Recorta el bbox de la ventana a la región de captura del objetivo"""
+        if bbox is None or target.capture_region is None:
+            return bbox
+        width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        left, top, right, bottom = target.capture_region
+        return (bbox[0] + int(width * left), bbox[1] + int(height * top),
+                bbox[0] + int(width * right), bbox[1] + int(height * bottom))
+
+
+# Controles estándar que se pueden resolver por el árbol de controles antes de usar visión.
+# Cada template tiene una lista de specs (auto_id, title_re, control_type); gana la primera que encuentre.
+CONTROL_SPECS = {
+    "Ok_button.png": [{"title_re": r"^&?(OK|Ok|Aceptar)$", "control_type": "Button"}],
+    "Aceptar_button.png": [{"title_re": r"^&?Aceptar$", "control_type": "Button"}],
+    "Close_button.png": [{"title_re": r"^&?(Close|Cerrar)$", "control_type": "Button"}],
+    "Cancel_button.png": [{"title_re": r"^&?(Cancel|Cancelar)$", "control_type": "Button"}],
+    "close_opt_console.png": [{"title_re": r"^&?(Close|Cerrar)$", "control_type": "Button"}],
+}
+
+
+class ControlLocator:
+    """Resuelve templates a controles estándar con un snapshot del árbol de controles en caché"""
+
+    def __init__(self, logger, specs=None, refresh_interval=2.0):
+        self.logger = logger
+        self.specs = specs if specs is not None else CONTROL_SPECS
+        self.refresh_interval = refresh_interval
+        self.snapshots: Dict[int, Dict] = {}      # handle de ventana -> {'controls': {hwnd: info}, 'time': t}
+        self.resolved: Dict[Tuple[int, str], int] = {}  # (ventana, template) -> hwnd del control
+        self.vision_calls_avoided = 0
+
+    def has_spec(self, template_name) -> bool:
+        return template_name in self.specs
+
+    def find(self, window_handle, template_name):
+        """Devuelve (centro absoluto, hwnd) del control del template o None si no está"""
+        if not window_handle or template_name not in self.specs:
+            return None
+        try:
+            from pywinauto import handleprops
+
+            if not handleprops.iswindow(window_handle):
+                self.snapshots.pop(window_handle, None)
+                return None
+
+            # 1) Handle ya resuelto: solo verificar que siga visible
+            hwnd = self.resolved.get((window_handle, template_name))
+            if hwnd and handleprops.iswindow(hwnd) and handleprops.isvisible(hwnd):
+                return self._center(hwnd), hwnd
+
+            # 2) Buscar en el snapshot; 3) refrescarlo (incremental) solo si falla y está viejo
+            hwnd = self._search_snapshot(window_handle, template_name)
+            if hwnd is None and self._refresh_snapshot(window_handle):
+                hwnd = self._search_snapshot(window_handle, template_name)
+            if hwnd is None:
+                return None
+
+            self.resolved[(window_handle, template_name)] = hwnd
+            return self._center(hwnd), hwnd
+        except Exception as e:
+            self.logger.error(f"Error buscando control para {template_name}: {e}")
+            return None
+
+    def _refresh_snapshot(self, window_handle) -> bool:
+        """Actualiza el snapshot consultando solo los controles nuevos; False si no tocaba refrescar"""
+        from pywinauto import handleprops
+
+        snapshot = self.snapshots.setdefault(window_handle, {'controls': {}, 'time': 0.0})
+        if time.time() - snapshot['time'] < self.refresh_interval:
+            return False
+        snapshot['time'] = time.time()
+
+        current = set(handleprops.children(window_handle))
+        controls = snapshot['controls']
+        for hwnd in list(controls):
+            if hwnd not in current:
+                del controls[hwnd]
+        for hwnd in current:
+            if hwnd not in controls:
+                controls[hwnd] = {
+                    'auto_id': str(handleprops.controlid(hwnd)),
+                    'title': handleprops.text(hwnd) or "",
+                    'class_name': handleprops.classname(hwnd) or "",
+                }
+        return True
+
+    def _search_snapshot(self, window_handle, template_name):
+        """Busca en el snapshot el primer control visible que cumpla alguna spec"""
+        from pywinauto import handleprops
+
+        controls = self.snapshots.get(window_handle, {}).get('controls', {})
+        for spec in self.specs[template_name]:
+            for hwnd, info in controls.items():
+                if self._matches(spec, info) and handleprops.isvisible(hwnd) and handleprops.isenabled(hwnd):
+                    return hwnd
+        return None
+
+    @staticmethod
+    def _matches(spec, info) -> bool:
+        if 'auto_id' in spec and spec['auto_id'] != info['auto_id']:
+            return False
+        if 'title_re' in spec and not re.match(spec['title_re'], info['title']):
+            return False
+        if 'control_type' in spec and spec['control_type'].lower() not in info['class_name'].lower():
+            return False
+        return True
+
+    @staticmethod
+    def _center(hwnd) -> Tuple[int, int]:
+        from pywinauto import handleprops
+        rect = handleprops.rectangle(hwnd)
+        return ((rect.left + rect.right) // 2, (rect.top + rect.bottom) // 2)
+
+
+# Mensajes de la consola de optimización que equivalen a cada trigger de fin de etapa
+STAGE_MESSAGE_PATTERNS = {
+    "End_Stage_2.png": r"(?i)\b(stage|etapa)\s*2\b.*\b(complete[d]?|finished|finalizad[ao]|terminad[ao])\b",
+}
+
+
+class ControlTextSource:
+    """Lee las líneas de la lista de mensajes de una ventana por el árbol de controles"""
+
+    LIST_CLASSES = ("listbox", "syslistview32", "listview", "richedit", "edit")
+
+    def __init__(self, logger, window_handle):
+        self.logger = logger
+        self.window_handle = window_handle
+        self.list_hwnd = None
+
+    def __call__(self) -> Optional[List[str]]:
+        """Devuelve las líneas actuales, o None si la ventana no expone texto"""
+        try:
+            from pywinauto import handleprops
+            from pywinauto.controls.hwndwrapper import HwndWrapper
+
+            if self.list_hwnd is None or not handleprops.iswindow(self.list_hwnd):
+                self.list_hwnd = self._find_list_control()
+                if self.list_hwnd is None:
+                    return None
+
+            control = HwndWrapper(self.list_hwnd)
+            texts = control.texts()[1:]  # texts()[0] es el texto de la ventana
+            if not texts:
+                texts = control.window_text().splitlines()
+            return texts
+        except Exception as e:
+            self.logger.error(f"Error leyendo texto de la consola: {e}")
+            self.list_hwnd = None
+            return None
+
+    def _find_list_control(self):
+        """Busca la lista de mensajes (la de mayor área entre los controles de texto)"""
+        from pywinauto import handleprops
+
+        best, best_area = None, 0
+        for hwnd in handleprops.children(self.window_handle):
+            class_name = (handleprops.classname(hwnd) or "").lower()
+            if not any(name in class_name for name in self.LIST_CLASSES):
+                continue
+            if not handleprops.isvisible(hwnd):
+                continue
+            rect = handleprops.rectangle(hwnd)
+            area = rect.width() * rect.height()
+            if area > best_area:
+                best, best_area = hwnd, area
+        return best
+
+
+class RecordedTextSource:
+    """Reproduce un flujo de texto grabado (una línea por mensaje) como si fuera la consola"""
+
+    def __init__(self, lines, lines_per_poll=5, history=0):
+        self.lines = list(lines)
+        self.lines_per_poll = lines_per_poll
+        self.position = history  # Líneas que ya estaban en la consola al empezar la espera
+
+    @classmethod
+    def from_file(cls, path, lines_per_poll=5, history=0):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return cls([line.rstrip("\n") for line in f], lines_per_poll, history)
+
+    def __call__(self) -> List[str]:
+        """Cada llamada revela algunas líneas más, como una consola que va creciendo"""
+        lines = self.lines[:self.position]
+        self.position = min(len(self.lines), self.position + self.lines_per_poll)
+        return lines
+
+
+class TemplateSet:
+    """Templates de una versión, idioma y tema de Monaco (un directorio de imágenes)"""
+
+    def __init__(self, name, directory: Path, version="*", language="*", theme="*", anchor="planning.PNG"):
+        self.name = name
+        self.directory = directory
+        self.version = version
+        self.language = language
+        self.theme = theme
+        self.anchor = anchor
+        # Índice sin distinguir mayúsculas: los pasos usan .png y los archivos son .PNG
+        self.index = {p.name.lower(): p for p in directory.iterdir()
+                      if p.is_file() and p.suffix.lower() == ".png"} if directory.is_dir() else {}
+
+    @classmethod
+    def from_manifest(cls, directory: Path):
+        """Lee set.json: {"version": ..., "language": ..., "theme": ..., "anchor": ...}"""
+        manifest = json.loads((directory / "set.json").read_text(encoding="utf-8"))
+        return cls(directory.name, directory, **{key: manifest[key] for key in
+                                                ("version", "language", "theme", "anchor") if key in manifest})
+
+    def describe(self) -> str:
+        return f"{self.name} (versión {self.version}, idioma {self.language}, tema {self.theme})"
+
+
+class TemplateLibrary:
+    """Conjuntos de templates por versión/idioma/tema: detecta el de esta estación y descarta los
+    templates que no existen en él. images/ es el conjunto base; images/sets/<nombre>/ con un set.json
+    define variantes que reemplazan archivos del base"""
+
+    def __init__(self, logger, log_callback, images_root: Path):
+        self.logger = logger
+        self.log_callback = log_callback
+        self.base = TemplateSet("base", images_root)
+        self.variants: List[TemplateSet] = []
+        sets_dir = images_root / "sets"
+        if sets_dir.is_dir():
+            for directory in sorted(sets_dir.iterdir()):
+                if (directory / "set.json").exists():
+                    try:
+                        self.variants.append(TemplateSet.from_manifest(directory))
+                    except Exception as e:
+                        self.logger.error(f"Error leyendo conjunto de templates {directory}: {e}")
+        self.active: Optional[TemplateSet] = None
+        self.reported_missing = set()
+
+    def path(self, template_name) -> Optional[Path]:
+        """Ruta del template en el conjunto activo, o en el base; None si no existe"""
+        key = Path(template_name).name.lower()
+        for template_set in (self.active, self.base):
+            if template_set is not None and key in template_set.index:
+                return template_set.index[key]
+        return None
+
+    def prune(self, template_names, keep=lambda name: False) -> List[str]:
+        """Deja solo los templates que existen (o que `keep` acepta aunque no tengan imagen, por ejemplo
+        los que se resuelven por el árbol de controles); avisa una sola vez por cada uno que falta"""
+        available = []
+        for name in template_names:
+            if self.path(name) is not None or keep(name):
+                available.append(name)
+            elif name not in self.reported_missing:
+                self.reported_missing.add(name)
+                self.log_callback(f"Template '{name}' no existe en el conjunto activo: se omite")
+        return available
+
+    def detect(self, anchor_score) -> bool:
+        """Elige la variante cuya ancla mejor coincide en pantalla (anchor_score(path) -> score).
+        Devuelve True si cambió el conjunto activo"""
+        best, best_score = None, 0.8
+        for variant in self.variants:
+            anchor_path = variant.index.get(variant.anchor.lower())
+            if anchor_path is None:
+                continue
+            score = anchor_score(anchor_path)
+            self.logger.info(f"Conjunto de templates {variant.name}: score del ancla {score:.3f}")
+            if score >= best_score:
+                best, best_score = variant, score
+        changed = best is not self.active
+        self.active = best
+        if changed:
+            self.reported_missing.clear()
+        self.log_callback(f"Conjunto de templates: {(best or self.base).describe()}")
+        return changed
+
+
+class LayoutModel:
+    """Predice la posición de cada template a partir de un ancla, con offsets aprendidos por resolución"""
+
+    def __init__(self, logger, anchor_template="planning.PNG", path=Path("monaco_bot_layout.json"),
+                 anchor_retry_interval=10.0):
+        self.logger = logger
+        self.anchor_template = anchor_template
+        self.path = path
+        self.anchor_retry_interval = anchor_retry_interval
+        self.offsets: Dict[str, Dict[str, List[int]]] = {}  # resolución -> template -> [dx, dy]
+        self.anchor_hits: Dict[Tuple, Tuple[int, int]] = {}  # bbox -> posición relativa del ancla
+        self.anchor_misses: Dict[Tuple, float] = {}          # bbox -> último intento fallido
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def resolution_key(window_bbox) -> str:
+        return f"{window_bbox[2] - window_bbox[0]}x{window_bbox[3] - window_bbox[1]}"
+
+    def load(self):
+        """Carga los offsets guardados (si existen)"""
+        try:
+            if self.path.exists():
+                self.offsets = json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception as e:
+            self.logger.error(f"Error cargando modelo de layout: {e}")
+            self.offsets = {}
+
+    def save(self):
+        """Guarda los offsets aprendidos si hubo cambios"""
+        if not self.dirty:
+            return
+        try:
+            self.path.write_text(json.dumps(self.offsets, indent=2), encoding="utf-8")
+            self.dirty = False
+        except Exception as e:
+            self.logger.error(f"Error guardando modelo de layout: {e}")
+
+    def should_search_anchor(self, window_bbox) -> bool:
+        """Evita buscar el ancla en cada poll cuando no está visible"""
+        last_miss = self.anchor_misses.get(tuple(window_bbox), 0.0)
+        return time.time() - last_miss >= self.anchor_retry_interval
+
+    def predict(self, window_bbox, template_name) -> Optional[Tuple[int, int]]:
+        """Posición relativa esperada del template, o None si no hay ancla u offset"""
+        anchor = self.anchor_hits.get(tuple(window_bbox))
+        offset = self.offsets.get(self.resolution_key(window_bbox), {}).get(template_name)
+        if anchor is None or offset is None:
+            return None
+        return (anchor[0] + offset[0], anchor[1] + offset[1])
+
+    def learn(self, window_bbox, template_name, top_left):
+        """Registra el offset del template respecto del ancla visible"""
+        anchor = self.anchor_hits.get(tuple(window_bbox))
+        if anchor is None or template_name == self.anchor_template:
+            return
+        offset = [int(top_left[0] - anchor[0]), int(top_left[1] - anchor[1])]
+        templates = self.offsets.setdefault(self.resolution_key(window_bbox), {})
+        if templates.get(template_name) != offset:
+            templates[template_name] = offset
+            self.dirty = True
+
+    def invalidate(self, inside):
+        """Descarta las posiciones de ancla de las regiones que cumplan inside(bbox)"""
+        self.anchor_hits = {b: pos for b, pos in self.anchor_hits.items() if not inside(b)}
+        self.anchor_misses = {b: t for b, t in self.anchor_misses.items() if not inside(b)}
+
+
+class TemplateHitStats:
+    """Frecuencia de aciertos por template, clase de ventana y paso; ordena los templates del más al
+    menos probable. Los conteos decaen para adaptarse a cambios y se guardan entre ejecuciones"""
+
+    def __init__(self, logger, path=Path("monaco_bot_estadisticas.json"), decay=0.98, min_tries=3):
+        self.logger = logger
+        self.path = path
+        self.decay = decay          # Peso de las observaciones anteriores en cada nueva
+        self.min_tries = min_tries  # Intentos en el paso antes de preferirlo a la estadística de la clase
+        self.data: Dict[str, Dict[str, List[float]]] = {}  # "clase|paso" -> template -> [aciertos, intentos]
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            if self.path.exists():
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception as e:
+            self.logger.error(f"Error cargando estadísticas de templates: {e}")
+            self.data = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.path.write_text(json.dumps(self.data, indent=2), encoding="utf-8")
+            self.dirty = False
+        except Exception as e:
+            self.logger.error(f"Error guardando estadísticas de templates: {e}")
+
+    def likelihood(self, template_name, window_class, step) -> float:
+        """Probabilidad estimada de acierto (Laplace); usa la del paso si tiene suficientes intentos"""
+        for context in (f"{window_class}|{step}", f"{window_class}|*"):
+            hits, tries = self.data.get(context, {}).get(template_name, (0.0, 0.0))
+            if tries >= self.min_tries or context.endswith("|*"):
+                return (hits + 1) / (tries + 2)
+        return 0.5
+
+    def order(self, template_names, window_class, step) -> List[str]:
+        """Orden de búsqueda: de mayor a menor probabilidad (a igual probabilidad, el orden dado).
+        No define a qué template se hace clic: eso lo decide la prioridad de la lista del usuario"""
+        return sorted(template_names, key=lambda name: -self.likelihood(name, window_class, step))
+
+    def record(self, template_name, window_class, step, hit):
+        for context in (f"{window_class}|{step}", f"{window_class}|*"):
+            counts = self.data.setdefault(context, {}).setdefault(template_name, [0.0, 0.0])
+            counts[0] = counts[0] * self.decay + (1.0 if hit else 0.0)
+            counts[1] = counts[1] * self.decay + 1.0
+        self.dirty = True
+
+
+class ScaleCalibration:
+    """Escala de cada template en esta estación (DPI/resolución), buscada una vez y persistida"""
+
+    SCALES = tuple(round(0.5 + 0.05 * i, 2) for i in range(31))  # 0.50 a 2.00
+
+    def __init__(self, logger, path=Path("monaco_bot_calibracion.json"), retry_interval=30.0):
+        self.logger = logger
+        self.path = path
+        self.retry_interval = retry_interval  # Entre intentos con el ancla todavía no visible
+        self.display_key = self.detect_display()
+        self.data: Dict[str, Dict[str, float]] = {}
+        self.calibrated_sizes = set()  # Tamaños de ventana ya calibrados en esta corrida
+        self.last_attempt: Dict[Tuple[int, int], float] = {}  # Tamaño sin calibrar -> último intento
+        self.dirty = False
+        self.load()
+
+    @staticmethod
+    def detect_display() -> str:
+        """Identifica la pantalla por resolución y DPI (la escala depende de ambos)"""
+        if sys.platform != 'win32':
+            return "default"
+        try:
+            import ctypes
+            user32 = ctypes.windll.user32
+            dpi = user32.GetDpiForSystem() if hasattr(user32, 'GetDpiForSystem') else 96
+            return f"{user32.GetSystemMetrics(0)}x{user32.GetSystemMetrics(1)}@{dpi}"
+        except Exception:
+            return "default"
+
+    def load(self):
+        try:
+            if self.path.exists():
+                self.data = json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception as e:
+            self.logger.error(f"Error cargando calibración de escala: {e}")
+            self.data = {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            self.path.write_text(json.dumps(self.data, indent=2), encoding="utf-8")
+            self.dirty = False
+        except Exception as e:
+            self.logger.error(f"Error guardando calibración de escala: {e}")
+
+    def scale_for(self, template_name) -> Optional[float]:
+        """Escala calibrada del template en esta pantalla (None si todavía no se calibró)"""
+        return self.data.get(self.display_key, {}).get(template_name)
+
+    def guess_scale(self) -> float:
+        """Escala probable para un template nuevo: la mediana de los ya calibrados"""
+        scales = list(self.data.get(self.display_key, {}).values())
+        return float(np.median(scales)) if scales else 1.0
+
+    def record(self, template_name, scale):
+        if self.scale_for(template_name) != scale:
+            self.data.setdefault(self.display_key, {})[template_name] = scale
+            self.dirty = True
+
+    def needs_calibration(self, window_bbox) -> bool:
+        """True si este tamaño de ventana no se calibró en la corrida y pasó retry_interval desde el
+        último intento (el ancla puede no estar en pantalla todavía)"""
+        size = LayoutModel.resolution_key(window_bbox)
+        if size in self.calibrated_sizes:
+            return False
+        now = time.time()
+        if now - self.last_attempt.get(size, 0.0) < self.retry_interval:
+            return False
+        self.last_attempt[size] = now
+        return True
+
+    def mark_calibrated(self, window_bbox):
+        self.calibrated_sizes.add(LayoutModel.resolution_key(window_bbox))
+
+    def forget(self, window_bbox=None):
+        """Vuelve a calibrar el tamaño dado (o todos) en la próxima espera"""
+        if window_bbox is None:
+            self.calibrated_sizes.clear()
+            self.last_attempt.clear()
+            return
+        size = LayoutModel.resolution_key(window_bbox)
+        self.calibrated_sizes.discard(size)
+        self.last_attempt.pop(size, None)
+
+    def calibrate_display(self, anchor_name, anchor, region, threshold=0.8) -> Optional[float]:
+        """Búsqueda multi-escala del ancla. Si su escala cambió, las de los demás templates quedan
+        viejas y se descartan (se vuelven a aprender con la nueva escala como estimación)"""
+        previous = self.scale_for(anchor_name)
+        result = self.calibrate(anchor_name, anchor, region, threshold)
+        if result is None:
+            return None
+        scale = result[0]
+        if previous is not None and previous != scale:
+            self.data[self.display_key] = {anchor_name: scale}
+            self.dirty = True
+            self.logger.info(f"Escala de pantalla cambió de {previous} a {scale}: se recalibran los templates")
+        return scale
+
+    @staticmethod
+    def resize(template, scale):
+        if scale == 1.0:
+            return template
+        interpolation = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR
+        return cv2.resize(template, None, fx=scale, fy=scale, interpolation=interpolation)
+
+    def calibrate(self, template_name, template, region, threshold):
+        """Búsqueda multi-escala; devuelve (escala, top_left) del mejor score sobre el umbral.
+        Primero una pasada gruesa a media resolución y después las escalas vecinas a resolución completa"""
+        def best_match(image, scales, factor):
+            best = (-1.0, None, None)
+            for scale in scales:
+                scaled = self.resize(template, scale * factor)
+                if scaled.shape[0] > image.shape[0] or scaled.shape[1] > image.shape[1] or min(scaled.shape[:2]) < 4:
+                    continue
+                _, max_val, _, max_loc = cv2.minMaxLoc(cv2.matchTemplate(image, scaled, cv2.TM_CCOEFF_NORMED))
+                if max_val > best[0]:
+                    best = (max_val, scale, max_loc)
+            return best
+
+        small = cv2.resize(region, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        coarse = best_match(small, self.SCALES[::2], 0.5)[1]
+        candidates = self.SCALES if coarse is None else [s for s in self.SCALES if abs(s - coarse) <= 0.101]
+        best = best_match(region, candidates, 1.0)
+        if best[1] is None or best[0] < threshold:
+            return None
+        self.record(template_name, best[1])
+        self.logger.info(f"Template {template_name} calibrado a escala {best[1]} (score {best[0]:.3f})")
+        return best[1], best[2]
+
+
+class ExactPixelMatcher:
+    """Coincidencia exacta (o casi) de píxeles para elementos que se dibujan siempre igual"""
+
+    def __init__(self, template, tolerance=6, n_probes=8, max_candidates=64):
+        self.template = template
+        self.tolerance = tolerance          # Diferencia máxima por canal
+        self.max_candidates = max_candidates
+        self.probes = self.select_probes(template, n_probes)
+        self._template_i16 = template.astype(np.int16)
+
+    @staticmethod
+    def select_probes(template, n_probes):
+        """Elige los píxeles de colores menos frecuentes del template (filtran más candidatos)"""
+        packed = (template[..., 0].astype(np.uint32) | (template[..., 1].astype(np.uint32) << 8) |
+                  (template[..., 2].astype(np.uint32) << 16)).ravel()
+        _, inverse, counts = np.unique(packed, return_inverse=True, return_counts=True)
+        order = np.argsort(counts[inverse], kind='stable')[:n_probes]
+        width = template.shape[1]
+        return [(int(i // width), int(i % width)) for i in order]
+
+    def _in_range(self, pixels, color):
+        lo = np.maximum(color.astype(np.int16) - self.tolerance, 0).astype(np.uint8)
+        hi = np.minimum(color.astype(np.int16) + self.tolerance, 255).astype(np.uint8)
+        return np.all((pixels >= lo) & (pixels <= hi), axis=-1)
+
+    def find(self, region) -> Optional[Tuple[int, int]]:
+        """Devuelve el top-left (x, y) de la primera coincidencia verificada o None"""
+        h, w = self.template.shape[:2]
+        out_h, out_w = region.shape[0] - h + 1, region.shape[1] - w + 1
+        if out_h <= 0 or out_w <= 0:
+            return None
+
+        # Primera sonda sobre toda la región; el resto solo en los candidatos que quedan
+        py, px = self.probes[0]
+        mask = self._in_range(region[py:py + out_h, px:px + out_w], self.template[py, px])
+        ys, xs = np.nonzero(mask)
+        for py, px in self.probes[1:]:
+            if len(ys) == 0:
+                return None
+            keep = self._in_range(region[ys + py, xs + px], self.template[py, px])
+            ys, xs = ys[keep], xs[keep]
+
+        # Verificación completa de los candidatos que pasaron todas las sondas
+        for y, x in zip(ys[:self.max_candidates], xs[:self.max_candidates]):
+            patch = region[y:y + h, x:x + w].astype(np.int16)
+            if np.abs(patch - self._template_i16).max() <= self.tolerance:
+                return (int(x), int(y))
+        return None
+
+
+def next_fast_len(n) -> int:
+    """Menor tamaño >= n cuyos factores son solo 2, 3 y 5 (FFT rápida)"""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def extract_peaks(res, threshold, k, template_shape) -> List[Tuple[Tuple[int, int], float]]:
+    """Hasta k coincidencias (top_left, score) >= threshold, de mayor a menor score y sin
+    solaparse. Con k=1 usa cv2.minMaxLoc (sin arreglos auxiliares)"""
+    if k == 1:
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        return [(max_loc, float(max_val))] if max_val >= threshold else []
+
+    # Máximos locales en una vecindad del tamaño del template: solo se indexan los picos
+    h, w = template_shape[:2]
+    res = np.ascontiguousarray(res, dtype=np.float32)
+    dilated = cv2.dilate(res, np.ones((2 * h - 1, 2 * w - 1), np.uint8))
+    ys, xs = np.nonzero((res >= threshold) & (res >= dilated))
+    scores = res[ys, xs]
+    order = np.argsort(-scores, kind='stable')
+
+    # Supresión de no máximos: descarta picos cuyo rectángulo se solapa con uno ya aceptado
+    matches = []
+    for i in order:
+        x, y = int(xs[i]), int(ys[i])
+        if all(abs(x - mx) >= w or abs(y - my) >= h for (mx, my), _ in matches):
+            matches.append(((x, y), float(scores[i])))
+            if len(matches) == k:
+                break
+    return matches
+
+
+class SpectralNCC:
+    """TM_CCOEFF_NORMED por FFT, reutilizando espectros de templates y del frame entre búsquedas.
+    Los espectros van en float32 (como OpenCV); las imágenes integrales en float64.
+    Solo la usa --benchmark-matchers: el espectro del frame cuesta ~2 matchTemplate y el bot busca uno o
+    dos templates por captura, así que en la automatización no se amortiza y se usa OpenCV."""
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes  # Cada espectro de template a 1920x1040 ocupa ~25 MB
+        self.template_cache: Dict[Tuple, Dict] = {}  # En orden de uso (el primero es el más viejo)
+        self.cache_bytes = 0
+        self.frame_key = None
+        self.frame_data: Optional[Dict] = None
+
+    def _frame(self, region, frame_key):
+        """Espectro e imágenes integrales del frame; se calculan una vez por captura"""
+        key = (frame_key, region.shape)
+        if self.frame_key != key or self.frame_data is None:
+            pixels = region.astype(np.float64)
+            fft_shape = (next_fast_len(region.shape[0]), next_fast_len(region.shape[1]))
+            integral = np.zeros((region.shape[0] + 1, region.shape[1] + 1, 3), np.float64)
+            integral_sq = np.zeros_like(integral)
+            integral[1:, 1:] = pixels.cumsum(0).cumsum(1)
+            integral_sq[1:, 1:] = (pixels * pixels).cumsum(0).cumsum(1)
+            self.frame_data = {
+                'fft_shape': fft_shape,
+                'spectrum': np.fft.rfft2(region.astype(np.float32), s=fft_shape, axes=(0, 1)),
+                'integral': integral,
+                'integral_sq': integral_sq,
+            }
+            self.frame_key = key
+        return self.frame_data
+
+    def _template(self, name, template, fft_shape):
+        """Espectro conjugado y norma del template centrado; se calculan una vez por tamaño de frame"""
+        key = (name, template.shape, fft_shape)
+        entry = self.template_cache.pop(key, None)
+        if entry is None:
+            centered = template.astype(np.float64)
+            centered -= centered.mean(axis=(0, 1))
+            entry = {
+                'spectrum': np.conj(np.fft.rfft2(centered.astype(np.float32), s=fft_shape, axes=(0, 1))),
+                'norm': float(np.sqrt((centered * centered).sum())),
+            }
+            self.cache_bytes += entry['spectrum'].nbytes
+            # Límite por memoria, no por cantidad: se descartan los menos usados
+            while self.template_cache and self.cache_bytes > self.max_bytes:
+                self.cache_bytes -= self.template_cache.pop(next(iter(self.template_cache)))['spectrum'].nbytes
+        self.template_cache[key] = entry
+        return entry
+
+    @staticmethod
+    def _window_sums(integral, h, w, out_h, out_w):
+        return (integral[h:h + out_h, w:w + out_w] - integral[:out_h, w:w + out_w] -
+                integral[h:h + out_h, :out_w] + integral[:out_h, :out_w])
+
+    def match(self, name, template, region, frame_key) -> np.ndarray:
+        """Mapa de resultados equivalente a cv2.matchTemplate(..., TM_CCOEFF_NORMED)"""
+        h, w = template.shape[:2]
+        out_h, out_w = region.shape[0] - h + 1, region.shape[1] - w + 1
+        frame = self._frame(region, frame_key)
+        entry = self._template(name, template, frame['fft_shape'])
+
+        # Numerador: correlación con el template centrado, sumando canales en frecuencia
+        product = (frame['spectrum'] * entry['spectrum']).sum(axis=2)
+        numerator = np.fft.irfft2(product, s=frame['fft_shape'])[:out_h, :out_w]
+
+        # Denominador: varianza local de la ventana por imágenes integrales
+        n = h * w
+        sums = self._window_sums(frame['integral'], h, w, out_h, out_w)
+        sums_sq = self._window_sums(frame['integral_sq'], h, w, out_h, out_w)
+        variance = np.maximum((sums_sq - sums * sums / n).sum(axis=2), 0.0)
+        denominator = np.sqrt(variance) * entry['norm']
+
+        result = np.zeros((out_h, out_w), np.float32)
+        valid = denominator > 1e-6 * max(entry['norm'], 1.0)
+        result[valid] = np.clip(numerator[valid] / denominator[valid], -1.0, 1.0)
+        return result
+
+
+class MatchTelemetry:
+    """Anillo en memoria con el mejor score, su posición y el tiempo de cada búsqueda de template.
+    Sirve para elegir umbrales por template y comparar distribuciones de score entre matchers"""
+
+    METHODS = ("ncc", "exacto", "cerca", "layout", "ancla")
+    DTYPE = np.dtype([('time', 'f8'), ('frame', 'u4'), ('template', 'u2'), ('method', 'u1'),
+                      ('score', 'f4'), ('x', 'i4'), ('y', 'i4'), ('threshold', 'f4'), ('elapsed_ms', 'f4')])
+
+    def __init__(self, capacity=200000, metrics: Optional[MetricsRegistry] = None):
+        self.metrics = metrics
+        self.ring = np.zeros(capacity, self.DTYPE)
+        self.count = 0  # Total registrado; el anillo guarda los últimos `capacity`
+        self.template_names: List[str] = []
+        self.template_ids: Dict[str, int] = {}
+        self.latest: Dict[str, Tuple[Optional[Tuple[int, int]], float]] = {}  # template -> último (top_left, score)
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def record(self, template, method, score, top_left, threshold, elapsed, frame=0):
+        """score NaN: el método no produce score (fallo del modo exacto)"""
+        template_id = self.template_ids.get(template)
+        if template_id is None:
+            template_id = self.template_ids[template] = len(self.template_names)
+            self.template_names.append(template)
+        x, y = top_left if top_left is not None else (-1, -1)
+        self.latest[template] = (top_left, score)
+        with self._lock:
+            self.ring[self.count % len(self.ring)] = (time.time(), frame, template_id, self.METHODS.index(method),
+                                                      score, x, y, threshold, elapsed * 1000)
+            self.count += 1
+        if self.metrics is not None:
+            self.metrics.observe("monaco_bot_match_seconds", elapsed, "Duración de cada búsqueda de template",
+                                 method=method)
+            self.metrics.inc("monaco_bot_matches_total", help_text="Búsquedas de template", method=method,
+                             result="acierto" if score >= threshold else "fallo")
+
+    def records(self) -> np.ndarray:
+        """Registros en orden cronológico"""
+        with self._lock:
+            if self.count <= len(self.ring):
+                return self.ring[:self.count].copy()
+            start = self.count % len(self.ring)
+            return np.concatenate((self.ring[start:], self.ring[:start]))
+
+    def best(self, template, since=0.0):
+        """(score, (x, y), método) del mejor intento del template desde `since`, o None"""
+        template_id = self.template_ids.get(template)
+        if template_id is None:
+            return None
+        rows = self.records()
+        rows = rows[(rows['template'] == template_id) & (rows['time'] >= since) & ~np.isnan(rows['score'])]
+        if len(rows) == 0:
+            return None
+        row = rows[np.argmax(rows['score'])]
+        return float(row['score']), (int(row['x']), int(row['y'])), self.METHODS[row['method']]
+
+    def summary(self, since=0.0) -> List[Tuple[str, float, int]]:
+        """[(template, mejor score, búsquedas)] desde `since`"""
+        rows = self.records()
+        rows = rows[rows['time'] >= since]
+        result = []
+        for template_id in np.unique(rows['template']):
+            scores = rows['score'][rows['template'] == template_id]
+            best = float(np.nanmax(scores)) if not np.all(np.isnan(scores)) else None
+            result.append((self.template_names[template_id], best, len(scores)))
+        return result
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Registros como columnas, con los nombres de template y método resueltos"""
+        rows = self.records()
+        columns = {name: rows[name] for name in self.DTYPE.names}
+        columns['template'] = np.array(self.template_names or [""], dtype=object)[rows['template']]
+        columns['method'] = np.array(self.METHODS, dtype=object)[rows['method']]
+        return columns
+
+    def save_csv(self, path: Path):
+        columns = self.columns()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            # Los nombres de template vienen de la lista libre de popups: pueden tener comas o comillas
+            writer = csv.writer(f)
+            writer.writerow(self.DTYPE.names)
+            for values in zip(*(columns[name] for name in self.DTYPE.names)):
+                writer.writerow(f"{v:.4f}" if isinstance(v, (float, np.floating)) else v for v in values)
+
+    def save_npz(self, path: Path):
+        """Formato columnar comprimido (np.load devuelve una columna por campo)"""
+        columns = self.columns()
+        columns['template'] = columns['template'].astype(str)
+        columns['method'] = columns['method'].astype(str)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, **columns)
+
+
+class TemplateMatchEngine:
+    """Elige por template entre coincidencia exacta de píxeles y NCC (cv2.matchTemplate)"""
+
+    def __init__(self, logger, ncc_check_every=10, promote_score=0.99, telemetry: Optional[MatchTelemetry] = None):
+        self.logger = logger
+        self.telemetry = telemetry
+        self.last_best = (None, float('nan'), 'exacto')  # (top_left, score, método) de la última búsqueda
+        self.ncc_check_every = ncc_check_every  # En modo exacto, cada cuántos fallos se verifica con NCC
+        self.promote_score = promote_score
+        self.modes: Dict[str, str] = {}         # template -> 'exacto' | 'ncc'
+        self.exact_matchers: Dict[str, ExactPixelMatcher] = {}
+        self.exact_misses: Dict[str, int] = {}
+
+    def exact_matcher(self, name, template) -> ExactPixelMatcher:
+        matcher = self.exact_matchers.get(name)
+        if matcher is None or matcher.template.shape != template.shape:
+            matcher = ExactPixelMatcher(template)
+            self.exact_matchers[name] = matcher
+        return matcher
+
+    def match_ncc(self, template, region, threshold):
+        """Mejor coincidencia NCC sobre la región; devuelve (top_left, score) o None"""
+        res = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+        top_left, score = extract_peaks(res, -np.inf, 1, template.shape)[0]
+        self.last_best = (top_left, score, 'ncc')
+        return (top_left, score) if score >= threshold else None
+
+    def find_all(self, template, region, threshold=0.9, k=5):
+        """Hasta k coincidencias NCC sin solaparse, [(top_left, score)] de mayor a menor score"""
+        if template.shape[0] > region.shape[0] or template.shape[1] > region.shape[1]:
+            return []
+        return extract_peaks(cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED), threshold, k, template.shape)
+
+    def find(self, name, template, region, threshold=0.9, frame_id=0):
+        """Devuelve (top_left, score) del template en la región o None; frame_id es el de la captura
+        de la que sale la región (para la telemetría)"""
+        if template.shape[0] > region.shape[0] or template.shape[1] > region.shape[1]:
+            return None
+        start = time.perf_counter()
+        # El modo exacto no da score en los fallos: queda NaN
+        self.last_best = (None, float('nan'), 'exacto')
+        hit = self._find(name, template, region, threshold)
+        if self.telemetry is not None:
+            top_left, score, method = self.last_best
+            self.telemetry.record(name, method, score, top_left, threshold, time.perf_counter() - start, frame_id)
+        return hit
+
+    def _find(self, name, template, region, threshold):
+        mode = self.modes.get(name)
+
+        if mode == 'exacto':
+            top_left = self.exact_matcher(name, template).find(region)
+            if top_left is not None:
+                self.exact_misses[name] = 0
+                self.last_best = (top_left, 1.0, 'exacto')
+                return top_left, 1.0
+            self.exact_misses[name] = self.exact_misses.get(name, 0) + 1
+            if self.exact_misses[name] % self.ncc_check_every:
+                return None
+            # Verificación periódica: si NCC lo encuentra, el modo exacto no es confiable
+            hit = self.match_ncc(template, region, threshold)
+            if hit is not None:
+                self.modes[name] = 'ncc'
+                self.logger.info(f"Template {name}: coincidencia exacta no confiable, se usa NCC")
+            return hit
+
+        hit = self.match_ncc(template, region, threshold)
+        if hit is not None and mode is None:
+            # Primer acierto: si el exacto da la misma posición, se usa exacto de ahora en más
+            exact = self.exact_matcher(name, template).find(region) if hit[1] >= self.promote_score else None
+            self.modes[name] = 'exacto' if exact == hit[0] else 'ncc'
+            self.logger.info(f"Template {name}: modo {self.modes[name]} (score NCC {hit[1]:.3f})")
+        return hit
+
+
+class Hotkey:
+    """Destino de un paso resuelto con un atajo de teclado en lugar de buscar y hacer clic"""
+
+    def __init__(self, keys, fallback_image, verify_timeout=3.0):
+        self.keys = keys                      # Sintaxis de pywinauto: {ENTER}, ^s, %c...
+        self.fallback_image = fallback_image  # Imagen a clickear si los atajos están desactivados o no actúan
+        self.verify_timeout = verify_timeout  # Segundos para que desaparezca el botón (o el trigger)
+
+    def __repr__(self):
+        return f"Hotkey({self.keys!r})"
+
+
+class TextEntry:
+    """Escribe texto en un campo con la estrategia más rápida disponible y verifica el resultado"""
+
+    EDIT_CLASSES = ("edit", "richedit", "combobox")
+    TEXT_FORMATS = (1, 7, 13, 16)  # CF_TEXT, CF_OEMTEXT, CF_UNICODETEXT, CF_LOCALE
+
+    def __init__(self, logger, verify_timeout=1.0, paste_settle=0.5):
+        self.logger = logger
+        self.verify_timeout = verify_timeout  # Las teclas se procesan de forma asíncrona
+        self.paste_settle = paste_settle      # Espera antes de restaurar el portapapeles sin verificación
+        self.saved_clipboard: Optional[str] = None
+        self.last_verified: Optional[bool] = None  # None: el campo no se pudo leer (ni Win32 ni UIA)
+
+    @staticmethod
+    def control_at(pos):
+        """Handle del control bajo la posición de pantalla (o None)"""
+        if sys.platform != 'win32':
+            return None
+        import ctypes
+        from ctypes import wintypes
+        return ctypes.windll.user32.WindowFromPoint(wintypes.POINT(int(pos[0]), int(pos[1]))) or None
+
+    def enter(self, text, pos, hwnd=None, focus_callback=None) -> Optional[str]:
+        """Prueba set_text, portapapeles y teclas en lote; devuelve la estrategia que funcionó"""
+        hwnd = hwnd or self.control_at(pos)
+        strategies = [("set_text", self._set_text),
+                      ("portapapeles", self._paste),
+                      ("teclas", self._send_batch)]
+        for name, strategy in strategies:
+            try:
+                start = time.perf_counter()
+                if not strategy(text, pos, hwnd, focus_callback):
+                    continue
+                verified = self.wait_verified(text, hwnd, pos)
+                if verified is None and self.saved_clipboard is not None:
+                    # Sin forma de confirmar el pegado: dar tiempo a que el destino procese ^V
+                    time.sleep(self.paste_settle)
+                self.restore_clipboard()
+                if verified is False:
+                    self.logger.warning(f"Texto no verificado con estrategia '{name}'")
+                    continue
+                self.last_verified = verified
+                if verified is None:
+                    self.logger.warning(f"Texto '{text}' enviado con '{name}' SIN VERIFICAR: el campo no se "
+                                        f"pudo leer")
+                else:
+                    self.logger.info(f"Texto '{text}' ingresado con '{name}' en "
+                                     f"{(time.perf_counter() - start) * 1000:.0f} ms")
+                return name
+            except Exception as e:
+                self.restore_clipboard()
+                self.logger.error(f"Error ingresando texto con '{name}': {e}")
+        return None
+
+    def verify(self, text, hwnd, pos=None) -> Optional[bool]:
+        """True/False si se pudo leer el campo; None si no. Un campo de edición Win32 se lee por su
+        handle; cualquier otro control (el texto de una ventana WPF/Qt es su título) por el
+        ValuePattern de UIA del elemento con foco, si está bajo la posición del clic"""
+        if hwnd and self._is_edit(hwnd):
+            from pywinauto import handleprops
+            current = handleprops.text(hwnd)
+        else:
+            current = self.focused_value(pos)
+        if current is None:
+            return None
+        return current.strip() == text.strip()
+
+    @staticmethod
+    def focused_value(pos) -> Optional[str]:
+        """Valor (UIA ValuePattern) del elemento con foco, o None si no tiene o no está en pos"""
+        if pos is None or sys.platform != 'win32':
+            return None
+        try:
+            from pywinauto.uia_defines import IUIA
+            from pywinauto.uia_element_info import UIAElementInfo
+            from pywinauto.controls.uiawrapper import UIAWrapper
+
+            control = UIAWrapper(UIAElementInfo(IUIA().iuia.GetFocusedElement()))
+            rect = control.rectangle()
+            if not (rect.left <= pos[0] < rect.right and rect.top <= pos[1] < rect.bottom):
+                return None  # El foco quedó en otro control: leerlo no dice nada del campo
+            return control.iface_value.CurrentValue
+        except Exception:
+            return None
+
+    def wait_verified(self, text, hwnd, pos=None) -> Optional[bool]:
+        """Repite la verificación hasta verify_timeout mientras el campo todavía no muestre el texto"""
+        deadline = time.perf_counter() + self.verify_timeout
+        while True:
+            verified = self.verify(text, hwnd, pos)
+            if verified is not False or time.perf_counter() >= deadline:
+                return verified
+            time.sleep(0.05)
+
+    def _is_edit(self, hwnd) -> bool:
+        from pywinauto import handleprops
+        class_name = (handleprops.classname(hwnd) or "").lower()
+        return any(name in class_name for name in self.EDIT_CLASSES)
+
+    def _set_text(self, text, pos, hwnd, focus_callback) -> bool:
+        """Asigna el texto directamente al control (sin clics ni teclas)"""
+        if not hwnd or not self._is_edit(hwnd):
+            return False
+        from pywinauto.controls.hwndwrapper import HwndWrapper
+        control = HwndWrapper(hwnd)
+        if not hasattr(control, 'set_edit_text'):
+            return False
+        control.set_edit_text(text)
+        return True
+
+    def _focus(self, pos, focus_callback):
+        if focus_callback:
+            focus_callback()
+        click(coords=pos)
+
+    def restore_clipboard(self):
+        """Devuelve al portapapeles lo que tenía antes de _paste (después de confirmar el pegado)"""
+        previous, self.saved_clipboard = self.saved_clipboard, None
+        if previous is None:
+            return
+        import win32clipboard
+
+        win32clipboard.OpenClipboard()
+        try:
+            win32clipboard.EmptyClipboard()
+            win32clipboard.SetClipboardData(win32clipboard.CF_UNICODETEXT, previous)
+        finally:
+            win32clipboard.CloseClipboard()
+
+    def _paste(self, text, pos, hwnd, focus_callback) -> bool:
+        """Pega el texto por el portapapeles; el contenido anterior lo restaura enter() al verificar.
+        Si el portapapeles tiene algo que no es texto (imagen, archivos) no se usa: no se podría restaurar"""
+        import win32clipboard
+
+        win32clipboard.OpenClipboard()
+        try:
+            formats, fmt = [], win32clipboard.EnumClipboardFormats(0)
+            while fmt:
+                formats.append(fmt)
+                fmt = win32clipboard.EnumClipboardFormats(fmt)
+            if any(fmt not in self.TEXT_FORMATS for fmt in formats):
+                self.logger.info("Portapapeles con datos que no son texto: se omite el pegado")
+                return False
+            previous = (win32clipboard.GetClipboardData(win32clipboard.CF_UNICODETEXT)
+                        if win32clipboard.CF_UNICODETEXT in formats else None)
+            win32clipboard.EmptyClipboard()
+            win32clipboard.SetClipboardData(win32clipboard.CF_UNICODETEXT, text)
+        finally:
+            win32clipboard.CloseClipboard()
+        self.saved_clipboard = previous
+
+        self._focus(pos, focus_callback)
+        send_keys("^a^v", pause=0)
+        return True
+
+    def _send_batch(self, text, pos, hwnd, focus_callback) -> bool:
+        """Envía todas las teclas en una sola llamada, sin pausa entre caracteres"""
+        self._focus(pos, focus_callback)
+        send_keys("^a", pause=0)
+        send_keys(re.sub(r"([+^%~(){}\[\]])", r"{\1}", text), with_spaces=True, pause=0)
+        return True
+
+
+class ConsoleStageDetector:
+    """Detecta el mensaje de fin de etapa en la consola sin capturar ni comparar imágenes"""
+
+    def __init__(self, logger, pattern, text_source):
+        self.logger = logger
+        self.pattern = re.compile(pattern)
+        self.text_source = text_source
+        self.lines_seen: Optional[int] = None  # None hasta la primera lectura
+        self.available = False  # True si la fuente devolvió texto en el último poll
+
+    def poll(self) -> Optional[str]:
+        """Revisa solo las líneas que llegaron después de la primera lectura y devuelve la que
+        coincide con el patrón"""
+        lines = self.text_source()
+        self.available = lines is not None
+        if lines is None:
+            return None
+
+        if self.lines_seen is None or len(lines) < self.lines_seen:
+            # Primera lectura, o la lista se filtró o se limpió: lo que ya está es historia (puede
+            # ser el fin de etapa de una corrida anterior) y solo cuentan los mensajes nuevos
+            self.lines_seen = len(lines)
+            return None
+        for line in lines[self.lines_seen:]:
+            if self.pattern.search(line):
+                return line
+        self.lines_seen = len(lines)
+        return None
+
+
+# Consola grabada de ejemplo: las primeras CONSOLE_REPLAY_HISTORY líneas ya estaban al empezar la espera
+CONSOLE_REPLAY_SAMPLE = [
+    "Optimization started",
+    "Stage 1 completed",
+    "Stage 2 completed",
+    "Optimization started",
+    "Iteration 10: objective 0.8731",
+    "Stage 1 completed",
+    "Stage 2 started",
+    "Iteration 20: objective 0.4120",
+    "Stage 12 completed",
+    "Stage 2 completed",
+    "Iteration 30: objective 0.4102",
+]
+CONSOLE_REPLAY_HISTORY = 3
+CONSOLE_REPLAY_EXPECTED = 9  # Índice de la línea que debe detectarse
+
+
+def replay_console(path=None, trigger="End_Stage_2.png", history=None, lines_per_poll=2) -> bool:
+    """Pasa un flujo de consola grabado por ConsoleStageDetector. Sin archivo usa CONSOLE_REPLAY_SAMPLE
+    y verifica que se detecte la línea esperada (no la de la historia); devuelve False si falla"""
+    if path:
+        source = RecordedTextSource.from_file(path, lines_per_poll, history or 0)
+        expected = None
+    else:
+        source = RecordedTextSource(CONSOLE_REPLAY_SAMPLE, lines_per_poll,
+                                    CONSOLE_REPLAY_HISTORY if history is None else history)
+        # Con otra historia la línea esperada cambia: solo se muestra el resultado
+        expected = CONSOLE_REPLAY_SAMPLE[CONSOLE_REPLAY_EXPECTED] if history is None else None
+    if trigger not in STAGE_MESSAGE_PATTERNS:
+        print(f"Sin patrón de consola para {trigger}: {', '.join(STAGE_MESSAGE_PATTERNS)}")
+        return False
+    detector = ConsoleStageDetector(logging.getLogger(__name__), STAGE_MESSAGE_PATTERNS[trigger], source)
+    print(f"Trigger {trigger}: {STAGE_MESSAGE_PATTERNS[trigger]}")
+    print(f"{len(source.lines)} líneas, {source.position} ya en la consola, {lines_per_poll} nuevas por poll")
+
+    message, index = None, None
+    polls = len(source.lines) // lines_per_poll + 2  # Alcanza para revelar todo y leerlo una vez más
+    for poll in range(1, polls + 1):
+        message = detector.poll()
+        if message is not None:
+            # poll() no avanza lines_seen cuando detecta: la línea está desde ahí en adelante
+            index = next(i for i in range(detector.lines_seen, len(source.lines))
+                         if detector.pattern.search(source.lines[i]))
+            print(f"Poll {poll}: detectado '{message}' (línea {index + 1})")
+            break
+    else:
+        print(f"Sin mensaje de fin de etapa después de {polls} polls")
+    if expected is None:
+        return True
+    ok = index == CONSOLE_REPLAY_EXPECTED
+    print("OK" if ok else f"FALLO: se esperaba '{expected}' (línea {CONSOLE_REPLAY_EXPECTED + 1})")
+    return ok
+
 
 class PopupDetector:
     """Clase para detectar y manejar ventanas emergentes con reconocimiento de imágenes"""
@@ -218,12 +2157,17 @@ class PopupDetector:
         self.log_callback = log_callback
         self.main_bot = main_bot  # Referencia al bot principal para usar sus métodos
         self.known_popups = []
+        self.match_attempts = 0  # Búsquedas de imagen en popups (para medir el orden por probabilidad)
+        self.popups_checked = 0
         
-    def get_all_visible_windows(self) -> List[Dict]:
-        """Obtiene todas las ventanas visibles del sistema"""
+    def get_all_visible_windows(self, process_ids=None) -> List[Dict]:
+        """Obtiene las ventanas visibles del sistema, o solo las de los procesos dados"""
         windows = []
         try:
-            all_handles = find_windows()
+            if process_ids is None:
+                all_handles = find_windows()
+            else:
+                all_handles = [handle for pid in process_ids for handle in find_windows(process=pid)]
             
             for handle in all_handles:
                 try:
@@ -290,20 +2234,48 @@ class PopupDetector:
         found_popups = []
         
         try:
-            all_windows = self.get_all_visible_windows()
-            
-            for window_info in all_windows:
-                if self.is_popup_window(window_info, main_window_handle):
-                    # Buscar imágenes en este popup
-                    for image_pattern in image_patterns:
-                        pos = self.main_bot.find_image_in_window(image_pattern, window_info['bbox'])
-                        if pos:
-                            popup_data = window_info.copy()
-                            popup_data['found_image'] = image_pattern
-                            popup_data['image_position'] = pos
-                            found_popups.append(popup_data)
-                            self.log_callback(f"Popup detectado con imagen '{image_pattern}': {window_info['title']}")
-                            break  # Solo necesitamos encontrar una imagen por popup
+            # Solo ventanas de los procesos de Monaco: nunca se tocan diálogos de otras aplicaciones
+            target_handles = self.main_bot.window_registry.handles()
+            monaco_pids = {WindowGeometryTracker.process_id(handle)
+                           for handle in target_handles + [main_window_handle] if handle} - {0}
+            if not monaco_pids:
+                return found_popups
+            all_windows = self.get_all_visible_windows(monaco_pids)
+            popup_windows = [w for w in all_windows
+                             if w['handle'] not in target_handles and self.is_popup_window(w, main_window_handle)]
+
+            # Una sola captura para todos los popups del barrido
+            self.main_bot.frame_grabber.declare_regions(w['bbox'] for w in popup_windows)
+
+            stats = self.main_bot.template_stats
+            step = self.main_bot.current_step
+            # El orden de la lista del usuario es la prioridad de clic (Ok antes que Cancel)
+            priority: Dict[str, int] = {}
+            for i, image_pattern in enumerate(image_patterns):
+                priority.setdefault(image_pattern, i)
+
+            for window_info in popup_windows:
+                # Se busca de la más a la menos probable para esta clase y paso, pero se hace clic en la
+                # de mayor prioridad: después de un acierto solo quedan por buscar las más prioritarias
+                self.popups_checked += 1
+                window_class = window_info['class_name']
+                best = None  # (prioridad, imagen, posición)
+                for image_pattern in stats.order(image_patterns, window_class, step):
+                    if best is not None and priority[image_pattern] >= best[0]:
+                        continue
+                    pos = self.main_bot.locate(image_pattern, window_info['window'], window_info['bbox'])
+                    self.match_attempts += 1
+                    stats.record(image_pattern, window_class, step, pos is not None)
+                    if pos:
+                        best = (priority[image_pattern], image_pattern, pos)
+                        if best[0] == 0:
+                            break
+                if best is not None:
+                    popup_data = window_info.copy()
+                    popup_data['found_image'] = best[1]
+                    popup_data['image_position'] = best[2]
+                    found_popups.append(popup_data)
+                    self.log_callback(f"Popup detectado con imagen '{best[1]}': {window_info['title']}")
                             
         except Exception as e:
             self.logger.error(f"Error buscando popups con imágenes: {e}")
@@ -311,32 +2283,723 @@ class PopupDetector:
         return found_popups
 
 
+class RepeatFilter(logging.Filter):
+    """Deja pasar un mensaje repetido una vez por ventana de tiempo y cuenta los suprimidos"""
+
+    def __init__(self, window=60.0, max_keys=2048):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        self.seen: Dict[Tuple, List] = {}  # (nivel, mensaje) -> [último emitido, suprimidos]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    def filter(self, record) -> bool:
+        key = (record.levelno, record.getMessage())
+        now = record.created
+        with self._lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[1] += 1
+                return False
+            if entry is not None and entry[1]:
+                record.msg = f"{record.getMessage()} (repetido {entry[1]} veces)"
+                record.args = None
+            if entry is None and len(self.seen) >= self.max_keys:
+                self.seen.pop(next(iter(self.seen)))
+            self.seen[key] = [now, 0]
+        return True
+
+    def flush(self, handler: logging.Handler, expired_only=False):
+        """Informa los repetidos pendientes (sin pasar por el filtro): los de ventanas ya vencidas,
+        o todos al terminar una corrida o cerrar"""
+        now = time.time()
+        pending = []
+        with self._lock:
+            for (level, message), entry in self.seen.items():
+                if entry[1] and (not expired_only or now - entry[0] >= self.window):
+                    pending.append((level, message, entry[1]))
+                    entry[1] = 0
+        for level, message, count in pending:
+            handler.emit(logging.makeLogRecord({'levelno': level, 'levelname': logging.getLevelName(level),
+                                                'msg': f"{message} (repetido {count} veces más)"}))
+
+    def start_flusher(self, handler: logging.Handler):
+        """Hilo que cada `window` segundos informa los repetidos de ráfagas ya terminadas"""
+        def loop():
+            while not self._stop.wait(self.window):
+                self.flush(handler, expired_only=True)
+        self._stop.clear()
+        self._flusher = threading.Thread(target=loop, daemon=True)
+        self._flusher.start()
+
+    def close(self, handler: logging.Handler):
+        self._stop.set()
+        self.flush(handler)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Encola sin bloquear nunca; si la cola está llena descarta y cuenta el registro"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BufferedShareHandler(logging.Handler):
+    """Escribe el log rotado junto al exe (posiblemente en un recurso de red). Si la escritura falla
+    o es lenta, guarda las líneas en un buffer y en una copia local hasta que el recurso responda"""
+
+    def __init__(self, path: Path, max_bytes=5 * 1024 * 1024, backup_count=3, slow_seconds=0.5,
+                 retry_interval=30.0, max_buffered=10000):
+        super().__init__()
+        self.share = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                                          encoding="utf-8", delay=True)
+        local_dir = Path(tempfile.gettempdir()) / "MonacoBot"
+        local_dir.mkdir(exist_ok=True)
+        self.local = logging.handlers.RotatingFileHandler(local_dir / path.name, maxBytes=max_bytes,
+                                                          backupCount=1, encoding="utf-8", delay=True)
+        self.slow_seconds = slow_seconds
+        self.retry_interval = retry_interval
+        self.buffer = deque(maxlen=max_buffered)
+        self.degraded_until = 0.0
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.share.setFormatter(fmt)
+        self.local.setFormatter(fmt)
+
+    def _write_share(self, record):
+        """Escribe en el recurso; a diferencia de FileHandler.emit, propaga los errores"""
+        if self.share.shouldRollover(record):
+            self.share.doRollover()
+        if self.share.stream is None:
+            self.share.stream = self.share._open()
+        self.share.stream.write(self.format(record) + self.share.terminator)
+
+    def _flush_buffer(self):
+        while self.buffer:
+            self._write_share(self.buffer[0])
+            self.buffer.popleft()
+
+    def emit(self, record):
+        self.local.emit(record)
+        if time.monotonic() < self.degraded_until:
+            self.buffer.append(record)
+            return
+        start = time.monotonic()
+        try:
+            self._flush_buffer()
+            self._write_share(record)
+            self.share.stream.flush()
+        except Exception:
+            self.buffer.append(record)
+            self.degraded_until = time.monotonic() + self.retry_interval
+            if self.share.stream is not None:
+                try:
+                    self.share.stream.close()
+                except Exception:
+                    pass
+                self.share.stream = None
+            return
+        if time.monotonic() - start > self.slow_seconds:
+            self.degraded_until = time.monotonic() + self.retry_interval
+
+    def close(self):
+        try:
+            self._flush_buffer()
+        except Exception:
+            pass  # Las líneas pendientes quedan en la copia local
+        self.share.close()
+        self.local.close()
+        super().close()
+
+
+class RunHistory:
+    """Historial de ejecuciones en SQLite: corridas, pasos con su duración, scores y popups.
+    Las escrituras se encolan y las hace un hilo propio en lotes (una transacción por lote)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY, started REAL, finished REAL, host TEXT, outcome TEXT, detail TEXT);
+        CREATE TABLE IF NOT EXISTS steps (
+            id INTEGER PRIMARY KEY, run_id INTEGER, name TEXT, started REAL, duration REAL, success INTEGER);
+        CREATE TABLE IF NOT EXISTS step_scores (
+            run_id INTEGER, step TEXT, template TEXT, best_score REAL, attempts INTEGER);
+        CREATE TABLE IF NOT EXISTS popups (
+            run_id INTEGER, step TEXT, time REAL, image TEXT, title TEXT);
+        CREATE TABLE IF NOT EXISTS artifacts (
+            run_id INTEGER, kind TEXT, path TEXT);
+        CREATE INDEX IF NOT EXISTS steps_by_name ON steps (name, started);
+    """
+
+    def __init__(self, logger, path: Optional[Path] = None, flush_interval=1.0):
+        self.logger = logger
+        self.path = path or self.default_path()
+        self.flush_interval = flush_interval
+        self.pending = queue.SimpleQueue()
+        self.run_id: Optional[int] = None
+        self._next_ids: Dict[str, int] = {}
+        self._writer: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @staticmethod
+    def default_path() -> Path:
+        """En un directorio local del usuario (%LOCALAPPDATA%\\MonacoBot), no junto al exe: el exe corre
+        desde un recurso compartido, donde el bloqueo de SQLite no es confiable y todas las estaciones
+        escribirían el mismo archivo"""
+        base = os.environ.get("LOCALAPPDATA") or tempfile.gettempdir()
+        return Path(base) / "MonacoBot" / "monaco_bot_historial.sqlite"
+
+    def start(self):
+        """Crea el esquema y arranca el hilo escritor"""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with sqlite3.connect(str(self.path)) as connection:
+                connection.executescript(self.SCHEMA)
+                for table in ("runs", "steps"):
+                    query = f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}"
+                    self._next_ids[table] = connection.execute(query).fetchone()[0]
+        except (sqlite3.Error, OSError) as e:
+            self.logger.error(f"Error abriendo historial de ejecuciones: {e}")
+            return False
+        self._stop.clear()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        return True
+
+    def stop(self):
+        if self._writer is not None:
+            self._stop.set()
+            self._writer.join(timeout=5)
+            self._writer = None
+
+    def _write_loop(self):
+        connection = sqlite3.connect(str(self.path))
+        try:
+            while not self._stop.is_set() or not self.pending.empty():
+                self._stop.wait(self.flush_interval)
+                batch = []
+                while not self.pending.empty():
+                    batch.append(self.pending.get_nowait())
+                if not batch:
+                    continue
+                try:
+                    with connection:
+                        for sql, params in batch:
+                            connection.execute(sql, params)
+                except sqlite3.Error as e:
+                    self.logger.error(f"Error escribiendo historial de ejecuciones: {e}")
+        finally:
+            connection.close()
+
+    def _new_id(self, table) -> int:
+        new_id = self._next_ids[table]
+        self._next_ids[table] += 1
+        return new_id
+
+    def _enqueue(self, sql, params):
+        if self._writer is not None:
+            self.pending.put((sql, params))
+
+    def begin_run(self):
+        if self._writer is None:
+            return
+        self.run_id = self._new_id("runs")
+        self._enqueue("INSERT INTO runs (id, started, host) VALUES (?, ?, ?)",
+                      (self.run_id, time.time(), platform.node()))
+
+    def end_run(self, outcome, detail=""):
+        if self.run_id is None:
+            return
+        self._enqueue("UPDATE runs SET finished = ?, outcome = ?, detail = ? WHERE id = ?",
+                      (time.time(), outcome, detail, self.run_id))
+        self.run_id = None
+
+    def record_artifact(self, kind, path):
+        """Archivo generado por la corrida (por ejemplo, el perfilado)"""
+        if self.run_id is None:
+            return
+        self._enqueue("INSERT INTO artifacts VALUES (?, ?, ?)", (self.run_id, kind, str(path)))
+
+    def record_step(self, name, started, duration, success, scores=()):
+        """scores: [(template, mejor score, intentos)] de las búsquedas hechas durante el paso"""
+        if self.run_id is None:
+            return
+        self._enqueue("INSERT INTO steps (id, run_id, name, started, duration, success) VALUES (?, ?, ?, ?, ?, ?)",
+                      (self._new_id("steps"), self.run_id, name, started, duration, int(bool(success))))
+        for template, best_score, attempts in scores:
+            self._enqueue("INSERT INTO step_scores VALUES (?, ?, ?, ?, ?)",
+                          (self.run_id, name, template, best_score, attempts))
+
+    def record_popup(self, step, image, title):
+        if self.run_id is None:
+            return
+        self._enqueue("INSERT INTO popups VALUES (?, ?, ?, ?, ?)", (self.run_id, step, time.time(), image, title))
+
+
+def run_history_report(path=None, weeks=8):
+    """Distribución de duración y tasa de fallos por paso (y por semana) de las últimas `weeks` semanas"""
+    path = path or RunHistory.default_path()
+    if not Path(path).exists():
+        print(f"No existe el historial {path}")
+        return
+    since = time.time() - weeks * 7 * 86400
+    with sqlite3.connect(str(path)) as connection:
+        rows = connection.execute(
+            "SELECT name, strftime('%Y-%W', started, 'unixepoch', 'localtime'), duration, success "
+            "FROM steps WHERE started >= ? ORDER BY started", (since,)).fetchall()
+        runs = connection.execute(
+            "SELECT COALESCE(outcome, 'sin terminar'), COUNT(*) FROM runs WHERE started >= ? GROUP BY 1",
+            (since,)).fetchall()
+        scores = connection.execute(
+            "SELECT s.template, COUNT(*), MIN(s.best_score), AVG(s.best_score) FROM step_scores s "
+            "JOIN runs r ON r.id = s.run_id WHERE r.started >= ? GROUP BY s.template ORDER BY s.template",
+            (since,)).fetchall()
+
+    print(f"Historial: {path} (últimas {weeks} semanas)")
+    print("Corridas: " + (", ".join(f"{outcome} {count}" for outcome, count in runs) or "ninguna"))
+
+    by_step: Dict[str, List[Tuple[str, float, int]]] = {}
+    for name, week, duration, success in rows:
+        by_step.setdefault(name, []).append((week, duration, success))
+
+    print(f"\n{'paso':32} {'n':>5} {'fallos':>7} {'p50 s':>8} {'p90 s':>8} {'p95 s':>8} {'máx s':>8} {'timeout sug.':>13}")
+    for name, entries in by_step.items():
+        durations = np.array([duration for _, duration, success in entries if success])
+        failures = sum(1 for _, _, success in entries if not success)
+        if len(durations):
+            p50, p90, p95 = np.percentile(durations, [50, 90, 95])
+            stats = f"{p50:8.1f} {p90:8.1f} {p95:8.1f} {durations.max():8.1f} {int(np.ceil(p95 * 1.5)):13d}"
+        else:
+            stats = f"{'-':>8} {'-':>8} {'-':>8} {'-':>8} {'-':>13}"
+        print(f"{name[:32]:32} {len(entries):5d} {failures / len(entries):7.0%} {stats}")
+
+    print(f"\n{'paso':32} {'semana':>8} {'n':>5} {'fallos':>7} {'p50 s':>8}")
+    for name, entries in by_step.items():
+        for week in sorted({week for week, _, _ in entries}):
+            weekly = [(duration, success) for w, duration, success in entries if w == week]
+            ok = [duration for duration, success in weekly if success]
+            p50 = f"{np.median(ok):8.1f}" if ok else f"{'-':>8}"
+            failures = sum(1 for _, success in weekly if not success)
+            print(f"{name[:32]:32} {week:>8} {len(weekly):5d} {failures / len(weekly):7.0%} {p50}")
+
+    if scores:
+        print(f"\n{'template':32} {'pasos':>6} {'mín score':>10} {'prom score':>11}")
+        for template, count, min_score, avg_score in scores:
+            # Sin score (NULL) cuando todas las búsquedas fueron en modo exacto
+            min_text = f"{min_score:10.3f}" if min_score is not None else f"{'-':>10}"
+            avg_text = f"{avg_score:11.3f}" if avg_score is not None else f"{'-':>11}"
+            print(f"{template[:32]:32} {count:6d} {min_text} {avg_text}")
+
+
+class RunProfiler:
+    """Perfilado del hilo de automatización durante una corrida o una ventana de tiempo: cProfile
+    (determinista) o muestreo de pilas y, a pedido, instantáneas de tracemalloc al terminar cada paso.
+    La memoria va aparte porque tracemalloc encarece cada asignación y distorsiona los tiempos"""
+
+    MODES = ("desactivado", "cprofile", "muestreo")
+
+    def __init__(self, logger, log_callback, sample_interval=0.005, memory_frames=1):
+        self.logger = logger
+        self.log_callback = log_callback
+        self.sample_interval = sample_interval
+        self.memory_frames = memory_frames
+        self.mode = "desactivado"
+        self.memory = False
+        self.directory: Optional[Path] = None
+        self.active = False
+        self.seconds = 0.0
+        self.started = 0.0
+        self.elapsed = 0.0
+        self.thread_id: Optional[int] = None
+        self.profile: Optional[cProfile.Profile] = None
+        self.sampler: Optional[threading.Thread] = None
+        self.self_samples: Counter = Counter()   # función -> muestras en el tope de la pila
+        self.total_samples: Counter = Counter()  # función -> muestras en cualquier lugar de la pila
+        self.stacks: Counter = Counter()         # pila plegada (formato flamegraph) -> muestras
+        self.sample_count = 0
+        self.idle_samples = 0
+        # Las instantáneas se escriben a disco al tomarlas; en memoria solo quedan la primera y la última
+        self.first_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.last_snapshot: Optional[tracemalloc.Snapshot] = None
+        self.snapshot_count = 0
+        self.owns_tracemalloc = False
+        self._stop = threading.Event()
+
+    def start(self, mode, directory: Path, seconds=0.0, memory=False):
+        """Llamar desde el hilo de automatización (cProfile solo perfila el hilo que lo activa).
+        Los resultados se guardan en directory"""
+        if mode not in self.MODES[1:]:
+            return False
+        self.mode, self.seconds, self.memory = mode, seconds, memory
+        self.directory = directory
+        directory.mkdir(parents=True, exist_ok=True)
+        self.thread_id = threading.get_ident()
+        self.self_samples.clear()
+        self.total_samples.clear()
+        self.stacks.clear()
+        self.sample_count = self.idle_samples = 0
+        self.first_snapshot = self.last_snapshot = None
+        self.snapshot_count = 0
+        self.elapsed = 0.0
+        self.owns_tracemalloc = memory and not tracemalloc.is_tracing()
+        if self.owns_tracemalloc:
+            tracemalloc.start(self.memory_frames)
+        if memory:
+            self.first_snapshot = self.write_snapshot("inicio")
+        self.started = time.perf_counter()
+        if mode == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self._stop.clear()
+            self.sampler = threading.Thread(target=self.sample_loop, daemon=True)
+            self.sampler.start()
+        self.active = True
+        window = f"{seconds:g} s" if seconds else "toda la corrida"
+        self.log_callback(f"Perfilado activado ({mode}{', con memoria' if memory else ''}, {window})")
+        return True
+
+    def check_window(self):
+        """Cierra la ventana de tiempo (desde el hilo de automatización, que es el que activó cProfile)"""
+        if self.active and self.seconds and time.perf_counter() - self.started >= self.seconds:
+            self.stop()
+
+    def snapshot(self, label):
+        """Instantánea de memoria (por ejemplo, al terminar un paso del ciclo de captura y búsqueda)"""
+        if self.active and self.memory:
+            self.write_snapshot(label)
+
+    def write_snapshot(self, label) -> Optional[tracemalloc.Snapshot]:
+        """Toma una instantánea y la escribe en el directorio del perfil"""
+        try:
+            snapshot = tracemalloc.take_snapshot()
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_")
+            snapshot.dump(str(self.directory / f"memoria_{self.snapshot_count:02d}_{slug}.tracemalloc"))
+            self.snapshot_count += 1
+            return snapshot
+        except Exception as e:
+            self.logger.error(f"Error guardando instantánea de memoria: {e}")
+            return None
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.elapsed = time.perf_counter() - self.started
+        if self.profile is not None:
+            self.profile.disable()
+        if self.sampler is not None:
+            self._stop.set()
+            self.sampler.join(timeout=2)
+            self.sampler = None
+        if self.memory:
+            self.last_snapshot = self.write_snapshot("fin")
+        if self.owns_tracemalloc:
+            tracemalloc.stop()
+        self.log_callback(f"Perfilado terminado ({self.elapsed:.1f} s)")
+
+    def sample_loop(self):
+        own_file = __file__
+        while not self._stop.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.sample_count += 1
+            # Dormido en pause(): espera, no trabajo del bot
+            if frame.f_code.co_name == "pause" and frame.f_code.co_filename == own_file:
+                self.idle_samples += 1
+                continue
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.self_samples[names[0]] += 1
+            for name in set(names):
+                self.total_samples[name] += 1
+            self.stacks[";".join(reversed(names))] += 1
+
+    def hot_functions(self, top=20) -> List[Tuple[str, float, float, int]]:
+        """[(función, segundos propios, segundos acumulados, llamadas)]; en muestreo, llamadas = muestras"""
+        if self.mode == "cprofile" and self.profile is not None:
+            stats = pstats.Stats(self.profile, stream=io.StringIO()).stats
+            rows = [(f"{name} ({Path(filename).name}:{line})", tottime, cumtime, calls)
+                    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.items()]
+            return sorted(rows, key=lambda row: row[1], reverse=True)[:top]
+        return [(name, count * self.sample_interval, self.total_samples[name] * self.sample_interval, count)
+                for name, count in self.self_samples.most_common(top)]
+
+    def top_allocators(self, top=15) -> List[Tuple[str, int, int]]:
+        """[(línea, bytes nuevos, bloques nuevos)] entre la primera y la última instantánea"""
+        if self.first_snapshot is None or self.last_snapshot is None:
+            return []
+        memory_filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                          tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+        first = self.first_snapshot.filter_traces(memory_filters)
+        last = self.last_snapshot.filter_traces(memory_filters)
+        return [(f"{Path(stat.traceback[0].filename).name}:{stat.traceback[0].lineno}", stat.size_diff,
+                 stat.count_diff) for stat in last.compare_to(first, "lineno")[:top]]
+
+    def summary(self, top=20) -> str:
+        out = [f"Perfilado {self.mode}: {self.elapsed:.1f} s"]
+        if self.mode == "muestreo":
+            out.append(f"Muestras: {self.sample_count} cada {self.sample_interval * 1000:.0f} ms "
+                       f"({self.idle_samples} en espera)")
+        calls = "llamadas" if self.mode == "cprofile" else "muestras"
+        out.append(f"\n{'propio s':>9} {'acum. s':>9} {calls:>9}  función")
+        for name, own, cumulative, calls in self.hot_functions(top):
+            out.append(f"{own:9.3f} {cumulative:9.3f} {calls:9d}  {name}")
+        if self.memory:
+            out.append(f"\n{'KiB':>10} {'bloques':>9}  línea (memoria nueva desde el inicio)")
+            for line, size, count in self.top_allocators(top):
+                out.append(f"{size / 1024:10.1f} {count:9d}  {line}")
+        return "\n".join(out)
+
+    def save(self):
+        """perfil.prof (pstats/snakeviz) o pilas.txt (flamegraph/speedscope) y resumen.txt; las
+        memoria_*.tracemalloc ya se escribieron durante la corrida"""
+        directory = self.directory
+        if self.mode == "cprofile" and self.profile is not None:
+            self.profile.dump_stats(str(directory / "perfil.prof"))
+        else:
+            with open(directory / "pilas.txt", "w", encoding="utf-8") as f:
+                for stack, count in self.stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        (directory / "resumen.txt").write_text(self.summary() + "\n", encoding="utf-8")
+
+
+class LogAnalyzer:
+    """Analiza monaco_bot.log línea a línea con memoria acotada: clases de mensajes repetidos,
+    errores, búsquedas por template y tiempos entre pasos"""
+
+    LINE_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - (\w+) - (.*)$")
+    TEMPLATE_RE = re.compile(r"[\w\-]+\.png", re.IGNORECASE)
+    PATH_RE = re.compile(r"(?:\b[A-Za-z]:\\|\\\\)[^'\"]*?(?=: |['\"]|$)")  # Rutas de Windows (con espacios)
+    NUMBER_RE = re.compile(r"\d+")
+    STEP_RE = re.compile(r"^(?:Paso iniciado|Ejecutando): (.+)$")
+
+    def __init__(self, max_classes=5000, gap_seconds=60.0, max_gaps=20, max_steps=500):
+        self.max_classes = max_classes
+        self.gap_seconds = gap_seconds  # Silencios más largos que esto se informan
+        self.max_gaps = max_gaps
+        self.lines = 0
+        self.unparsed = 0
+        self.levels = Counter()
+        self.classes = Counter()                     # (nivel, mensaje normalizado) -> apariciones
+        self.longest_runs: Dict[Tuple, int] = {}     # clase -> mayor racha consecutiva
+        self.error_spans: Dict[Tuple, List] = {}     # clase de error -> [primera, última]
+        self.template_lookups = Counter()
+        self.template_errors = Counter()
+        self.steps = deque(maxlen=max_steps)  # (hora, paso) de los últimos pasos
+        self.gaps: List[Tuple[float, datetime]] = []
+        self.first_time = self.last_time = None
+        self._run_class = None
+        self._run_length = 0
+        self._last_stamp = None
+        self._last_second = None
+
+    @staticmethod
+    def decode(raw: bytes) -> str:
+        """UTF-8 o cp1252 (logs viejos); repara el UTF-8 leído como cp1252 ('FÃ­sicos' -> 'Físicos')"""
+        try:
+            text = raw.decode("utf-8")
+        except UnicodeDecodeError:
+            text = raw.decode("cp1252", errors="replace")
+        if "Ã" in text or "Â" in text:
+            try:
+                text = text.encode("cp1252").decode("utf-8")
+            except UnicodeError:
+                pass
+        return text.rstrip("\r\n")
+
+    def normalize(self, message) -> str:
+        message = self.PATH_RE.sub("<ruta>", message)
+        message = self.TEMPLATE_RE.sub("<imagen>", message)
+        return self.NUMBER_RE.sub("N", message)
+
+    def feed(self, line):
+        self.lines += 1
+        match = self.LINE_RE.match(line)
+        if match is None:
+            self.unparsed += 1  # Tracebacks y líneas partidas
+            return
+        stamp, millis, level, message = match.groups()
+        if stamp != self._last_stamp:  # strptime solo una vez por segundo de log
+            self._last_stamp, self._last_second = stamp, datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S")
+        when = self._last_second.replace(microsecond=int(millis) * 1000)
+        self.levels[level] += 1
+
+        if self.last_time is not None:
+            gap = (when - self.last_time).total_seconds()
+            if gap >= self.gap_seconds:
+                self.gaps.append((gap, self.last_time))
+                if len(self.gaps) > self.max_gaps:
+                    self.gaps.remove(min(self.gaps))
+        self.first_time = self.first_time or when
+        self.last_time = when
+
+        key = (level, self.normalize(message))
+        if key in self.classes or len(self.classes) < self.max_classes:
+            self.classes[key] += 1
+        else:
+            self.classes[(level, "<otros>")] += 1
+        self._run_length = self._run_length + 1 if key == self._run_class else 1
+        self._run_class = key
+        if self._run_length > self.longest_runs.get(key, 0) and key in self.classes:
+            self.longest_runs[key] = self._run_length
+
+        if level in ("ERROR", "CRITICAL") and key in self.classes:
+            span = self.error_spans.setdefault(key, [when, when])
+            span[1] = when
+
+        for template in self.TEMPLATE_RE.findall(message):
+            template = template.lower()
+            if level in ("ERROR", "CRITICAL"):
+                self.template_errors[template] += 1
+            else:
+                self.template_lookups[template] += 1
+
+        step = self.STEP_RE.match(message)
+        if step:
+            self.steps.append((when, step.group(1)))
+
+    def feed_file(self, path):
+        with open(path, "rb") as f:
+            for raw in f:
+                self.feed(self.decode(raw))
+
+    def report(self, top=15) -> str:
+        out = [f"Líneas: {self.lines} ({self.unparsed} sin formato)  Niveles: " +
+               ", ".join(f"{level} {count}" for level, count in self.levels.most_common())]
+        if self.first_time:
+            out.append(f"Período: {self.first_time} a {self.last_time}")
+
+        out.append(f"\nMensajes más repetidos ({len(self.classes)} clases distintas):")
+        for (level, message), count in self.classes.most_common(top):
+            out.append(f"  {count:7d} x  (racha máx. {self.longest_runs.get((level, message), 1):5d})  "
+                       f"{level}: {message[:110]}")
+
+        errors = [(key, count) for key, count in self.classes.most_common() if key in self.error_spans]
+        out.append(f"\nClases de error: {len(errors)}")
+        for key, count in errors[:top]:
+            first, last = self.error_spans[key]
+            out.append(f"  {count:7d} x  {first:%Y-%m-%d %H:%M} a {last:%Y-%m-%d %H:%M}  {key[1][:100]}")
+
+        out.append("\nBúsquedas por template (menciones / errores):")
+        for template in sorted(set(self.template_lookups) | set(self.template_errors),
+                               key=lambda t: -(self.template_lookups[t] + self.template_errors[t])):
+            out.append(f"  {template:36} {self.template_lookups[template]:7d} {self.template_errors[template]:7d}")
+
+        if self.steps:
+            out.append("\nPasos (tiempo hasta el siguiente paso):")
+            steps = list(self.steps)
+            for (when, name), (next_when, _) in zip(steps, steps[1:] + [(self.last_time, "")]):
+                out.append(f"  {when:%Y-%m-%d %H:%M:%S}  {(next_when - when).total_seconds():8.1f} s  {name}")
+        else:
+            out.append("\nSin marcas de paso en el log (se agregan desde esta versión)")
+
+        if self.gaps:
+            out.append(f"\nSilencios de más de {self.gap_seconds:.0f} s:")
+            for gap, after in sorted(self.gaps, reverse=True):
+                out.append(f"  {gap:10.1f} s  después de {after:%Y-%m-%d %H:%M:%S}")
+        return "\n".join(out)
+
+
+def analyze_logs(paths, top=15):
+    analyzer = LogAnalyzer()
+    for path in paths:
+        analyzer.feed_file(path)
+    print(analyzer.report(top))
+
+
 class MonacoBot:
-    def __init__(self):
+    def __init__(self, metrics_port=9464, flight_minutes=5.0, profile_mode="desactivado", profile_seconds=0.0,
+                 profile_memory=False):
         self.setup_logging()
         self.create_gui()
+        self.profile_mode_var.set(profile_mode)
+        self.profile_seconds_var.set(str(profile_seconds))
+        self.profile_memory_var.set(profile_memory)
+        self.profiler = RunProfiler(self.logger, self.log_to_gui)
         self.running = False
+        self.tracer = SpanTracer()
+        self.metrics = MetricsRegistry()
+        self.match_telemetry = MatchTelemetry(metrics=self.metrics)
+        self.flight_recorder = FlightRecorder(self.logger, self.log_to_gui, telemetry=self.match_telemetry,
+                                              minutes=flight_minutes)
+        self.register_process_metrics()
+        self.frame_grabber = FrameGrabber(self.logger, tracer=self.tracer, metrics=self.metrics,
+                                          recorder=self.flight_recorder)
+        self.geometry_tracker = WindowGeometryTracker(self.logger, self.log_to_gui)
+        self.geometry_tracker.add_listener(self.on_window_geometry_changed)
+        self.window_registry = WindowRegistry(self.logger, self.log_to_gui, self.geometry_tracker)
+        self.control_locator = ControlLocator(self.logger)
+        self.text_entry = TextEntry(self.logger)
+        self.last_hits: Dict[Tuple, Tuple[int, int]] = {}
+        self.template_cache: Dict[str, Optional[np.ndarray]] = {}
+        self.scaled_template_cache: Dict[Tuple[str, float], np.ndarray] = {}
+        self.scale_calibration = ScaleCalibration(self.logger)
+        self.run_history = RunHistory(self.logger)
+        self.run_history.start()
+        self.failed_steps: List[str] = []
+        self.match_engine = TemplateMatchEngine(self.logger, telemetry=self.match_telemetry)
+        self.layout_model = LayoutModel(self.logger)
+        self.template_stats = TemplateHitStats(self.logger)
+        self.current_step = "inicio"
+        self.console_stage_confirmed = set()  # Triggers cuyo mensaje de consola ya se vio coincidir
+        self.template_library = TemplateLibrary(self.logger, self.log_to_gui, self.resource_path(Path("images")))
         self.popup_detector = PopupDetector(self.logger, self.log_to_gui, self)
         self.main_window_handle = None
         self.debug_viewer = DebugImageViewer(self.logger, self.log_to_gui)
+        self.metrics_server = MetricsServer(self.logger, self.metrics, metrics_port)
+        if metrics_port:
+            self.metrics_server.start()
         
     def setup_logging(self):
-        """Configura el sistema de logging"""
+        """Configura el logging: el hilo de automatización solo encola, la escritura la hace otro hilo"""
         log_file = Path("monaco_bot.log")
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.FileHandler(log_file),
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        file_handler = BufferedShareHandler(log_file)
+        file_handler.setFormatter(formatter)
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(formatter)
+
+        self.log_queue_handler = DroppingQueueHandler(queue.Queue(maxsize=10000))
+        self.repeat_filter = RepeatFilter()
+        self.log_queue_handler.addFilter(self.repeat_filter)
+        self.repeat_filter.start_flusher(self.log_queue_handler)
+        self.log_listener = logging.handlers.QueueListener(self.log_queue_handler.queue, file_handler, console_handler)
+        self.log_listener.start()
+        logging.basicConfig(level=logging.INFO, handlers=[self.log_queue_handler])
         self.logger = logging.getLogger(__name__)
+
+    def stop_logging(self):
+        """Vacía la cola de logging y cierra los archivos"""
+        if self.log_queue_handler.dropped:
+            self.logger.warning(f"Mensajes de log descartados por cola llena: {self.log_queue_handler.dropped}")
+        self.repeat_filter.close(self.log_queue_handler)
+        self.log_listener.stop()
+        for handler in self.log_listener.handlers:
+            handler.close()
         
     def create_gui(self):
         """Crea la interfaz gráfica"""
         self.root = tk.Tk()
         self.root.title("Monaco Bot - Automatización con Detección de Popups")
+        # El hilo de automatización no toca widgets: encola y el loop de Tk aplica en lotes
+        self.gui_queue = queue.SimpleQueue()
+        self.gui_poll_ms = 100
+        self.max_gui_batch = 2000
+        self.max_log_lines = 2000
         self.root.geometry("700x650")
         self.root.resizable(True, True)
         
@@ -364,16 +3027,56 @@ class MonacoBot:
         window_entry = ttk.Entry(config_frame, textvariable=self.window_var)
         window_entry.grid(row=0, column=1, sticky=(tk.W, tk.E), padx=(0, 5))
         
-        ttk.Label(config_frame, text="Timeout (seg):").grid(row=1, column=0, sticky=tk.W, padx=(0, 5))
+        ttk.Label(config_frame, text="Consola de optimización:").grid(row=1, column=0, sticky=tk.W, padx=(0, 5))
+        self.optconsole_window_var = tk.StringVar(value="Optimization")
+        optconsole_entry = ttk.Entry(config_frame, textvariable=self.optconsole_window_var)
+        optconsole_entry.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=(0, 5))
+        
+        ttk.Label(config_frame, text="Timeout (seg):").grid(row=2, column=0, sticky=tk.W, padx=(0, 5))
         self.timeout_var = tk.StringVar(value="1200")
         timeout_entry = ttk.Entry(config_frame, textvariable=self.timeout_var)
-        timeout_entry.grid(row=1, column=1, sticky=(tk.W, tk.E), padx=(0, 5))
+        timeout_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), padx=(0, 5))
         
         # Configuración de popups
-        ttk.Label(config_frame, text="Detección de popups:").grid(row=2, column=0, sticky=tk.W, padx=(0, 5))
+        ttk.Label(config_frame, text="Detección de popups:").grid(row=3, column=0, sticky=tk.W, padx=(0, 5))
         self.popup_detection_var = tk.BooleanVar(value=True)
         popup_check = ttk.Checkbutton(config_frame, variable=self.popup_detection_var)
-        popup_check.grid(row=2, column=1, sticky=tk.W)
+        popup_check.grid(row=3, column=1, sticky=tk.W)
+        
+        ttk.Label(config_frame, text="Usar atajos de teclado:").grid(row=4, column=0, sticky=tk.W, padx=(0, 5))
+        self.use_hotkeys_var = tk.BooleanVar(value=False)
+        hotkeys_check = ttk.Checkbutton(config_frame, variable=self.use_hotkeys_var)
+        hotkeys_check.grid(row=4, column=1, sticky=tk.W)
+
+        ttk.Label(config_frame, text="Guardar traza de tiempos:").grid(row=5, column=0, sticky=tk.W, padx=(0, 5))
+        self.trace_var = tk.BooleanVar(value=False)
+        trace_check = ttk.Checkbutton(config_frame, variable=self.trace_var)
+        trace_check.grid(row=5, column=1, sticky=tk.W)
+
+        ttk.Label(config_frame, text="Guardar telemetría de coincidencias:").grid(row=6, column=0, sticky=tk.W,
+                                                                              padx=(0, 5))
+        self.telemetry_var = tk.BooleanVar(value=False)
+        telemetry_check = ttk.Checkbutton(config_frame, variable=self.telemetry_var)
+        telemetry_check.grid(row=6, column=1, sticky=tk.W)
+
+        ttk.Label(config_frame, text="Grabador de vuelo (capturas recientes):").grid(row=7, column=0, sticky=tk.W,
+                                                                                  padx=(0, 5))
+        self.flight_recorder_var = tk.BooleanVar(value=False)
+        flight_recorder_check = ttk.Checkbutton(config_frame, variable=self.flight_recorder_var)
+        flight_recorder_check.grid(row=7, column=1, sticky=tk.W)
+
+        ttk.Label(config_frame, text="Perfilado:").grid(row=8, column=0, sticky=tk.W, padx=(0, 5))
+        profile_frame = ttk.Frame(config_frame)
+        profile_frame.grid(row=8, column=1, sticky=tk.W)
+        self.profile_mode_var = tk.StringVar(value="desactivado")
+        ttk.Combobox(profile_frame, textvariable=self.profile_mode_var, values=RunProfiler.MODES,
+                     state="readonly", width=12).pack(side=tk.LEFT, padx=(0, 5))
+        ttk.Label(profile_frame, text="ventana (seg, 0 = toda la corrida):").pack(side=tk.LEFT, padx=(0, 5))
+        self.profile_seconds_var = tk.StringVar(value="0")
+        ttk.Entry(profile_frame, textvariable=self.profile_seconds_var, width=6).pack(side=tk.LEFT)
+        self.profile_memory_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(profile_frame, text="memoria (más lento)",
+                        variable=self.profile_memory_var).pack(side=tk.LEFT, padx=(5, 0))
         
         # Configuración de imágenes de popup
         popup_images_frame = ttk.LabelFrame(main_frame, text="Imágenes de Popup", padding="5")
@@ -420,16 +3123,32 @@ class MonacoBot:
 
         self.debug_button = ttk.Button(button_frame, text="Ver Debug Visual", command=self.toggle_debug_window)
         self.debug_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        self.metrics_button = ttk.Button(button_frame, text="Ver Métricas", command=self.toggle_metrics_panel)
+        self.metrics_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        self.flight_dump_button = ttk.Button(button_frame, text="Guardar Grabación", command=self.dump_flight_recorder)
+        self.flight_dump_button.pack(side=tk.LEFT, padx=(0, 5))
+
+        # Panel de métricas (oculto hasta que se pida)
+        self.metrics_frame = ttk.LabelFrame(main_frame, text="Métricas", padding="5")
+        self.metrics_frame.grid(row=7, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=(10, 0))
+        self.metrics_text_var = tk.StringVar(value="")
+        ttk.Label(self.metrics_frame, textvariable=self.metrics_text_var, font=("Consolas", 9),
+                  justify=tk.LEFT).grid(row=0, column=0, sticky=tk.W)
+        self.metrics_frame.grid_remove()
+        self.metrics_panel_visible = False
         
         # Configurar el grid principal para que se expanda
         main_frame.rowconfigure(6, weight=1)
     
     def get_popup_image_list(self) -> List[str]:
-        """Obtiene la lista de imágenes a buscar en popups"""
+        """Obtiene la lista de imágenes a buscar en popups (las del conjunto activo o con control conocido)"""
         images_str = self.popup_images_var.get().strip()
         if not images_str:
             return []
-        return [img.strip() for img in images_str.split(',') if img.strip()]
+        return self.template_library.prune((img.strip() for img in images_str.split(',') if img.strip()),
+                                           keep=self.control_locator.has_spec)
     
     def test_popup_detection(self):
         """Prueba la detección de popups manualmente"""
@@ -453,6 +3172,8 @@ class MonacoBot:
         else:
             self.log_to_gui("No se detectaron ventanas emergentes con las imágenes especificadas")
     
+    @traced("check_and_handle_popups")
+    @timed("monaco_bot_popup_sweep_seconds", "Duración de cada barrido de popups")
     def check_and_handle_popups(self) -> bool:
         """Verifica y maneja ventanas emergentes buscando imágenes específicas"""
         if not self.popup_detection_var.get():
@@ -472,14 +3193,17 @@ class MonacoBot:
                     try:
                         # Enfocar el popup
                         popup['window'].set_focus()
-                        time.sleep(0.3)
+                        self.pause(0.3)
                         
                         # Hacer clic en la imagen encontrada
                         pos = popup['image_position']
                         self.click_at_position(pos)
+                        self.metrics.inc("monaco_bot_popups_handled_total", help_text="Popups cerrados",
+                                         image=popup['found_image'])
+                        self.run_history.record_popup(self.current_step, popup['found_image'], popup['title'])
                         self.log_to_gui(f"Clic en popup '{popup['title']}' en imagen '{popup['found_image']}'")
                         
-                        time.sleep(0.5)  # Pausa entre manejo de popups
+                        self.pause(0.5)  # Pausa entre manejo de popups
                         
                     except Exception as e:
                         self.logger.error(f"Error manejando popup: {e}")
@@ -493,16 +3217,46 @@ class MonacoBot:
         return False
         
     def log_to_gui(self, message):
-        """Añade mensaje al log de la GUI"""
+        """Añade mensaje al log de la GUI (seguro desde cualquier hilo)"""
         timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
-        self.log_text.see(tk.END)
-        self.root.update_idletasks()
-        
+        self.gui_queue.put(("log", f"[{timestamp}] {message}\n"))
+
     def update_status(self, status):
-        """Actualiza el status en la GUI"""
-        self.status_var.set(status)
-        self.root.update_idletasks()
+        """Actualiza el status en la GUI (seguro desde cualquier hilo)"""
+        self.gui_queue.put(("status", status))
+
+    def run_on_gui(self, callback):
+        """Ejecuta callback en el hilo de Tk"""
+        self.gui_queue.put(("call", callback))
+
+    def drain_gui_queue(self):
+        """Aplica los mensajes pendientes en un solo lote y se reprograma"""
+        lines = []
+        status = None
+        try:
+            for _ in range(self.max_gui_batch):
+                kind, payload = self.gui_queue.get_nowait()
+                if kind == "log":
+                    lines.append(payload)
+                elif kind == "status":
+                    status = payload
+                else:
+                    payload()
+        except queue.Empty:
+            pass
+        except Exception as e:
+            self.logger.error(f"Error actualizando la GUI: {e}")
+
+        if lines:
+            self.log_text.insert(tk.END, "".join(lines[-self.max_log_lines:]))
+            # Vista acotada: solo las últimas líneas (el historial completo está en monaco_bot.log)
+            line_count = int(self.log_text.index("end-1c").split(".")[0])
+            if line_count > self.max_log_lines:
+                self.log_text.delete("1.0", f"{line_count - self.max_log_lines}.0")
+            self.log_text.see(tk.END)
+        if status is not None:
+            self.status_var.set(status)
+        self.root.after(self.gui_poll_ms, self.drain_gui_queue)
         
     def start_automation(self):
         """Inicia la automatización in un hilo separado"""
@@ -520,9 +3274,7 @@ class MonacoBot:
     def stop_automation(self):
         """Detiene la automatización"""
         self.running = False
-        self.start_button.config(state=tk.NORMAL)
-        self.stop_button.config(state=tk.DISABLED)
-        self.progress.stop()
+        self.reset_controls()
         self.update_status("Detenido por el usuario")
         self.log_to_gui("Automatización detenida por el usuario")
         
@@ -541,12 +3293,13 @@ class MonacoBot:
         try:
             base_path = getattr(sys, '_MEIPASS', Path(__file__).parent.resolve())
             full_path = Path(base_path) / relative_path
-            self.logger.info(f"Ruta de recurso: {full_path}")
+            self.logger.debug(f"Ruta de recurso: {full_path}")
             return full_path
         except Exception as e:
             self.logger.error(f"Error resolviendo ruta: {e}")
             return None
 
+    @traced("get_window_and_bbox")
     def get_window_and_bbox(self, title_substring):
         """Encuentra y maximiza la ventana objetivo"""
         try:
@@ -563,8 +3316,7 @@ class MonacoBot:
                 time.sleep(1)
 
             dlg.set_focus()
-            rect = dlg.rectangle()
-            bbox = (rect.left, rect.top, rect.right, rect.bottom)
+            bbox = self.geometry_tracker.track(dlg)
             self.log_to_gui(f"Ventana encontrada: {title_substring} - {bbox}")
             return dlg, bbox
         except Exception as e:
@@ -572,152 +3324,519 @@ class MonacoBot:
             self.log_to_gui(f"ERROR: No se pudo encontrar la ventana '{title_substring}'")
             return None, None
 
+    @traced("find_image_in_window")
     def find_image_in_window(self, template_path, window_bbox, threshold=0.9):
         """Busca una imagen template en la ventana especificada"""
         try:
-            generalized_template_path = self.resource_path(Path("images") / template_path)
-            
-            if not generalized_template_path or not generalized_template_path.exists():
+            template = self.get_template(template_path)
+            if template is None:
                 # No loggear como error si estamos buscando en popups
                 return None
 
-            screenshot = ImageGrab.grab(bbox=window_bbox)
-            
-            self.debug_viewer.update_image(
-                screenshot_pil=screenshot,
-                template_path=str(generalized_template_path),
-                template_image=template,
-                search_result=center_abs if 'center_abs' in locals() else None,
-                step_info=f"Buscando: {template_path}"
-            )
-
-            screenshot_cv = cv2.cvtColor(np.array(screenshot), cv2.COLOR_RGB2BGR)
-            
-            template = self.load_image_as_cv2(str(generalized_template_path))
-            if template is None:
-                return None
+            # Vista de la captura compartida del tick (sin copia ni nueva captura). Todas las búsquedas
+            # de esta llamada usan la misma captura aunque el grabber capture otra mientras tanto
+            frame, screenshot_cv = self.frame_grabber.get_frame_region(window_bbox)
+            h, w = template.shape[:2]
 
-            res = cv2.matchTemplate(screenshot_cv, template, cv2.TM_CCOEFF_NORMED)
-            loc = np.where(res >= threshold)
-            
-            if len(loc[0]) > 0:
-                top_left = (loc[1][0], loc[0][0])
-                h, w = template.shape[:2]
+            # Primero buscar alrededor de la última posición conocida
+            hit_key = (template_path, tuple(window_bbox))
+            top_left = None
+            if hit_key in self.last_hits:
+                top_left = self.match_near(template, window_bbox, self.last_hits[hit_key], threshold,
+                                           template_name=template_path, frame=frame)
+
+            # Después en la posición que predice el layout a partir del ancla
+            if top_left is None:
+                predicted = self.predict_from_layout(template_path, window_bbox, threshold, frame)
+                if predicted is not None:
+                    top_left = self.match_near(template, window_bbox, predicted, threshold, margin=4,
+                                               template_name=template_path, method="layout", frame=frame)
+
+            if top_left is None:
+                hit = self.match_engine.find(template_path, template, screenshot_cv, threshold, frame.frame_id)
+                if hit is not None:
+                    top_left = hit[0]
+                    self.layout_model.learn(window_bbox, template_path, top_left)
+                    if self.scale_calibration.scale_for(template_path) is None:
+                        self.scale_calibration.record(template_path, self.scale_calibration.guess_scale())
+
+            center_abs = None
+            if top_left is not None:
+                self.last_hits[hit_key] = top_left
                 center_rel = (top_left[0] + w // 2, top_left[1] + h // 2)
-                center_abs = (window_bbox[0] + center_rel[0], window_bbox[1] + center_rel[1])
-                return center_abs
+                center_abs = self.frame_grabber.to_absolute(window_bbox, center_rel)
+
+            if self.debug_viewer.is_visible:
+                self.debug_viewer.update_image(
+                    screenshot_bgr=screenshot_cv,
+                    template_path=template_path,
+                    template_image=template,
+                    search_result=center_abs,
+                    step_info=f"Buscando: {template_path}",
+                    best_match=self.viewer_match(template_path, top_left)
+                )
+            return center_abs
+        except Exception as e:
+            self.logger.error(f"Error buscando imagen {template_path}: {e}")
             return None
+
+    def viewer_match(self, template_path, top_left):
+        """(top_left, score) para el visor: la coincidencia, o el mejor intento si no la hubo"""
+        latest = self.match_telemetry.latest.get(template_path)
+        if top_left is None:
+            return latest
+        return top_left, latest[1] if latest is not None and latest[0] == tuple(top_left) else float("nan")
+
+    def find_all_in_window(self, template_path, window_bbox, threshold=0.9, k=5):
+        """Todas las apariciones del template en la ventana (hasta k), [(centro absoluto, score)]
+        de mayor a menor score"""
+        try:
+            template = self.get_template(template_path)
+            if template is None:
+                return []
+            h, w = template.shape[:2]
+            region = self.frame_grabber.get_region(window_bbox)
+            matches = self.match_engine.find_all(template, region, threshold, k)
+            return [(self.frame_grabber.to_absolute(window_bbox, (x + w // 2, y + h // 2)), score)
+                    for (x, y), score in matches]
         except Exception as e:
             self.logger.error(f"Error buscando imagen {template_path}: {e}")
+            return []
+
+    def get_stage_detector(self, current, trigger_img, window):
+        """Devuelve el detector de texto para el trigger, recreándolo si cambió la ventana"""
+        if window is None or trigger_img not in STAGE_MESSAGE_PATTERNS:
+            return None
+        if current is not None and current.text_source.window_handle == window.handle:
+            return current
+        return ConsoleStageDetector(self.logger, STAGE_MESSAGE_PATTERNS[trigger_img],
+                                    ControlTextSource(self.logger, window.handle))
+
+    def locate(self, template_path, dlg, window_bbox, threshold=0.9):
+        """Ubica el template por el árbol de controles y, si no hay control, por imagen"""
+        if dlg is not None and self.control_locator.has_spec(template_path):
+            found = self.control_locator.find(dlg.handle, template_path)
+            if found:
+                self.control_locator.vision_calls_avoided += 1
+                return found[0]
+        return self.find_image_in_window(template_path, window_bbox, threshold)
+
+    def get_template(self, template_path, scale=None):
+        """Carga el template una sola vez (None si no existe) y lo lleva a la escala de esta pantalla"""
+        if template_path not in self.template_cache:
+            full_path = self.template_library.path(template_path)
+            template = None
+            if full_path is not None:
+                template = self.load_image_as_cv2(str(full_path))
+            self.template_cache[template_path] = template
+
+        template = self.template_cache[template_path]
+        if template is None:
+            return None
+        if scale is None:
+            scale = self.scale_calibration.scale_for(template_path) or self.scale_calibration.guess_scale()
+        key = (template_path, scale)
+        if key not in self.scaled_template_cache:
+            self.scaled_template_cache[key] = ScaleCalibration.resize(template, scale)
+        return self.scaled_template_cache[key]
+
+    def ensure_scale_calibrated(self, window_bbox):
+        """Una búsqueda multi-escala del ancla por corrida y tamaño de ventana (no por cada fallo);
+        mientras el ancla no aparezca se reintenta cada retry_interval"""
+        if not self.scale_calibration.needs_calibration(window_bbox):
+            return
+        anchor_name = self.layout_model.anchor_template
+        anchor = self.get_template(anchor_name, scale=1.0)
+        if anchor is None:
+            return
+        self.frame_grabber.new_tick([window_bbox])
+        scale = self.scale_calibration.calibrate_display(anchor_name, anchor, self.frame_grabber.get_region(window_bbox))
+        if scale is None:
+            self.log_to_gui(f"Calibración de escala: {anchor_name} no visible, se usa la escala estimada "
+                            f"(se reintenta en {self.scale_calibration.retry_interval:.0f} s)")
+            return
+        self.scale_calibration.mark_calibrated(window_bbox)
+        self.scaled_template_cache.clear()
+        self.match_engine = TemplateMatchEngine(self.logger, telemetry=self.match_telemetry)
+
+    def select_template_set(self, window_bbox):
+        """Detecta versión/idioma/tema por el ancla de cada conjunto y vacía las cachés si cambia"""
+        if not self.template_library.variants:
+            self.log_to_gui(f"Conjunto de templates: {self.template_library.base.describe()}")
+            return
+        self.frame_grabber.new_tick([window_bbox])
+        region = self.frame_grabber.get_region(window_bbox)
+        scale = self.scale_calibration.guess_scale()
+
+        def anchor_score(path):
+            anchor = self.load_image_as_cv2(str(path))
+            if anchor is None:
+                return 0.0
+            anchor = ScaleCalibration.resize(anchor, scale)
+            if anchor.shape[0] > region.shape[0] or anchor.shape[1] > region.shape[1]:
+                return 0.0
+            return float(cv2.minMaxLoc(cv2.matchTemplate(region, anchor, cv2.TM_CCOEFF_NORMED))[1])
+
+        if self.template_library.detect(anchor_score):
+            self.template_cache.clear()
+            self.scaled_template_cache.clear()
+            self.last_hits.clear()
+            self.match_engine = TemplateMatchEngine(self.logger, telemetry=self.match_telemetry)
+
+    def predict_from_layout(self, template_path, window_bbox, threshold=0.9, frame: Optional[CapturedFrame] = None):
+        """Posición esperada del template según el ancla; ubica el ancla si hace falta (en frame, o en
+        la captura del tick si no se pasa)"""
+        if template_path == self.layout_model.anchor_template:
+            return None
+        bbox_key = tuple(window_bbox)
+        if bbox_key not in self.layout_model.anchor_hits:
+            if not self.layout_model.should_search_anchor(window_bbox):
+                return None
+            anchor = self.get_template(self.layout_model.anchor_template)
+            if anchor is None:
+                return None
+            region = frame.view(window_bbox) if frame is not None else self.frame_grabber.get_region(window_bbox)
+            res = cv2.matchTemplate(region, anchor, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(res)
+            if max_val < threshold:
+                self.layout_model.anchor_misses[bbox_key] = time.time()
+                return None
+            self.layout_model.anchor_hits[bbox_key] = max_loc
+        else:
+            # Verificación barata de que el ancla sigue en su lugar
+            anchor = self.get_template(self.layout_model.anchor_template)
+            if self.match_near(anchor, window_bbox, self.layout_model.anchor_hits[bbox_key], threshold, margin=2,
+                               template_name=self.layout_model.anchor_template, method="ancla",
+                               frame=frame) is None:
+                del self.layout_model.anchor_hits[bbox_key]
+                return None
+        return self.layout_model.predict(window_bbox, template_path)
+
+    def match_near(self, template, window_bbox, last_top_left, threshold, margin=16, template_name=None,
+                   method="cerca", frame: Optional[CapturedFrame] = None):
+        """Busca el template en una región chica alrededor de la posición esperada (en frame, o en la
+        captura del tick si no se pasa)"""
+        start = time.perf_counter()
+        h, w = template.shape[:2]
+        roi = (max(window_bbox[0], window_bbox[0] + last_top_left[0] - margin),
+               max(window_bbox[1], window_bbox[1] + last_top_left[1] - margin),
+               min(window_bbox[2], window_bbox[0] + last_top_left[0] + w + margin),
+               min(window_bbox[3], window_bbox[1] + last_top_left[1] + h + margin))
+        if roi[2] - roi[0] < w or roi[3] - roi[1] < h:
+            return None
+
+        if frame is None:
+            frame, region = self.frame_grabber.get_frame_region(roi)
+        else:
+            region = frame.view(roi)
+        res = cv2.matchTemplate(region, template, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        top_left = (roi[0] - window_bbox[0] + max_loc[0], roi[1] - window_bbox[1] + max_loc[1])
+        if template_name is not None:
+            self.match_telemetry.record(template_name, method, max_val, top_left, threshold,
+                                        time.perf_counter() - start, frame.frame_id)
+        if max_val < threshold:
             return None
+        return top_left
+
+    def on_window_geometry_changed(self, handle, old_bbox, new_bbox):
+        """Invalida las cachés que dependen de la geometría de la ventana"""
+        def inside_old(bbox):
+            return (bbox[0] >= old_bbox[0] and bbox[1] >= old_bbox[1] and
+                    bbox[2] <= old_bbox[2] and bbox[3] <= old_bbox[3])
+
+        # Incluye las regiones de captura recortadas dentro de la ventana
+        self.last_hits = {key: pos for key, pos in self.last_hits.items() if not inside_old(key[1])}
+        self.layout_model.invalidate(inside_old)
+        self.frame_grabber.invalidate()
+        # Cambio de tamaño: la próxima espera vuelve a calibrar la escala con el ancla
+        if LayoutModel.resolution_key(old_bbox) != LayoutModel.resolution_key(new_bbox):
+            self.scale_calibration.forget(old_bbox)
+            self.scale_calibration.forget(new_bbox)
+
+    def pause(self, seconds):
+        """time.sleep con span: en la traza distingue la espera del trabajo del bot"""
+        self.profiler.check_window()
+        with self.tracer.span("espera", "espera"):
+            time.sleep(seconds)
 
+    @traced("click_at_position")
     def click_at_position(self, pos):
         """Hace clic en una posición específica"""
         try:
             move(coords=pos)
             time.sleep(0.2)
             click(coords=pos)
+            self.metrics.inc("monaco_bot_clicks_total", help_text="Clics realizados")
+            # La pantalla cambia después del clic: la captura del tick ya no sirve
+            self.frame_grabber.invalidate()
             self.log_to_gui(f"Clic realizado en: {pos}")
         except Exception as e:
             self.logger.error(f"Error haciendo clic en {pos}: {e}")
 
-    def wait_and_click(self, dlg, window_bbox, trigger_img, destination_img, timeout=30):
-        """Espera por una imagen trigger y hace clic en la imagen destino"""
+    def wait_and_click(self, target, trigger_img, destination_img, timeout=30):
+        """Espera por una imagen trigger en la ventana objetivo y hace clic en la imagen destino"""
         if not self.running:
             return False
             
-        self.log_to_gui(f"Esperando imagen: {trigger_img}")
+        window_bbox = None
+        self.log_to_gui(f"Esperando imagen: {trigger_img} (ventana '{target}')")
         self.update_status(f"Esperando: {trigger_img}")
         
         start_time = time.time()
         popup_check_interval = 2  # Verificar popups cada 2 segundos
         last_popup_check = 0
+        stage_detector = None
+        polls = 0
         
         while self.running and time.time() - start_time < timeout:
+            # Nuevo tick: una sola captura para ventana objetivo y popups
+            dlg, window_bbox = self.window_registry.resolve(target)
+            if window_bbox is None:
+                self.pause(1)
+                continue
+            if not self.window_registry.is_fallback(target):
+                self.ensure_scale_calibrated(window_bbox)
+            self.frame_grabber.new_tick([window_bbox])
+
             # Verificar popups periódicamente
             current_time = time.time()
             if current_time - last_popup_check >= popup_check_interval:
                 if self.check_and_handle_popups():
                     # Si se manejó un popup, esperar un poco antes de continuar
-                    time.sleep(1)
+                    self.pause(1)
                 last_popup_check = current_time
             
-            pos_trigger = self.find_image_in_window(trigger_img, window_bbox)
+            # Con la ventana de respaldo no se usan controles: podrían ser de otra ventana
+            control_window = None if self.window_registry.is_fallback(target) else dlg
+
+            # Fin de etapa por texto de la consola. La imagen se sigue buscando en cada poll hasta que
+            # el patrón coincidió alguna vez (el filtro de la consola puede ocultar el mensaje);
+            # después queda como verificación cada 10 polls
+            stage_detector = self.get_stage_detector(stage_detector, trigger_img, control_window)
+            if stage_detector is not None:
+                message = stage_detector.poll()
+                if message:
+                    self.log_to_gui(f"Mensaje de fin de etapa en consola: {message}")
+                    self.console_stage_confirmed.add(trigger_img)
+                    break
+            polls += 1
+            if (stage_detector is not None and stage_detector.available and
+                    trigger_img in self.console_stage_confirmed and polls % 10):
+                self.control_locator.vision_calls_avoided += 1
+                self.pause(1)
+                continue
+
+            pos_trigger = self.locate(trigger_img, control_window, window_bbox)
             if pos_trigger:
                 self.log_to_gui(f"Imagen detectada: {trigger_img}")
                 break
-            time.sleep(1)
+            self.pause(1)
         
         if not self.running:
             return False
             
         if time.time() - start_time >= timeout:
             self.log_to_gui(f"TIMEOUT esperando: {trigger_img}")
+            self.log_best_match(trigger_img, start_time)
             return False
 
         # Verificar popups una vez más antes de continuar
         self.check_and_handle_popups()
 
+        if isinstance(destination_img, Hotkey):
+            hotkey, destination_img = destination_img, destination_img.fallback_image
+            if self.use_hotkeys_var.get():
+                if self.send_hotkey(hotkey, target, trigger_img):
+                    return True
+                if not self.running:
+                    return False
+                self.log_to_gui(f"El atajo {hotkey.keys} no tuvo efecto visible: se usa la imagen {destination_img}")
+                dlg, window_bbox = self.window_registry.resolve(target)
+                if window_bbox is None:
+                    return False
+                control_window = None if self.window_registry.is_fallback(target) else dlg
+                self.frame_grabber.new_tick([window_bbox])
+
         self.log_to_gui(f"Buscando destino: {destination_img}")
-        pos_dest = self.find_image_in_window(destination_img, window_bbox)
+        pos_dest = self.locate(destination_img, control_window, window_bbox)
         if pos_dest:
             self.click_at_position(pos_dest)
             # Verificar popups después del clic
-            time.sleep(1)
+            self.pause(1)
             self.check_and_handle_popups()
             return True
         else:
             self.log_to_gui(f"No se encontró imagen destino: {destination_img}")
             return False
 
-    def wait_for_image_and_type_text(self, dlg, window_bbox, image_path, text_to_type="A-B-C", timeout=30):
-        """Espera por una imagen y escribe texto"""
+    def log_best_match(self, template_path, since):
+        """Informa cuán cerca estuvo el template del umbral desde `since` (para diagnosticar timeouts)"""
+        best = self.match_telemetry.best(template_path, since)
+        if best is None:
+            self.log_to_gui(f"  {template_path}: sin scores registrados (no se buscó por imagen o no hubo NCC)")
+        else:
+            score, top_left, method = best
+            self.log_to_gui(f"  {template_path}: mejor score {score:.3f} en {top_left} ({method})")
+
+    def send_hotkey(self, hotkey: Hotkey, target, trigger_img) -> bool:
+        """Enfoca la ventana objetivo, envía el atajo y confirma que desapareció el botón que reemplaza
+        (o el trigger, si el botón no estaba visible). False si no se pudo confirmar"""
+        dlg, window_bbox = self.window_registry.resolve(target)
+        if dlg is None or window_bbox is None:
+            return False
+        control_window = None if self.window_registry.is_fallback(target) else dlg
+        watched = (hotkey.fallback_image if self.locate(hotkey.fallback_image, control_window, window_bbox)
+                   else trigger_img)
+        try:
+            dlg.set_focus()
+            send_keys(hotkey.keys, pause=0)
+            self.frame_grabber.invalidate()
+        except Exception as e:
+            self.logger.error(f"Error enviando atajo {hotkey.keys}: {e}")
+            return False
+
+        deadline = time.time() + hotkey.verify_timeout
+        while self.running and time.time() < deadline:
+            self.pause(0.5)
+            dlg, window_bbox = self.window_registry.resolve(target)
+            if window_bbox is None:
+                continue
+            self.frame_grabber.new_tick([window_bbox])
+            if not self.locate(watched, control_window, window_bbox):
+                self.log_to_gui(f"Atajo enviado: {hotkey.keys} ({watched} ya no está visible)")
+                # Verificar popups después del atajo
+                self.check_and_handle_popups()
+                return True
+        return False
+
+    def wait_for_image_and_type_text(self, target, image_path, text_to_type="A-B-C", timeout=30):
+        """Espera por una imagen en la ventana objetivo y escribe texto"""
         if not self.running:
             return False
             
-        self.log_to_gui(f"Esperando imagen para escribir: {image_path}")
+        self.log_to_gui(f"Esperando imagen para escribir: {image_path} (ventana '{target}')")
         start_time = time.time()
         popup_check_interval = 2
         last_popup_check = 0
         
         while self.running and time.time() - start_time < timeout:
+            # Nuevo tick: una sola captura para ventana objetivo y popups
+            dlg, window_bbox = self.window_registry.resolve(target)
+            if window_bbox is None:
+                self.pause(1)
+                continue
+            if not self.window_registry.is_fallback(target):
+                self.ensure_scale_calibrated(window_bbox)
+            self.frame_grabber.new_tick([window_bbox])
+
             # Verificar popups periódicamente
             current_time = time.time()
             if current_time - last_popup_check >= popup_check_interval:
                 if self.check_and_handle_popups():
-                    time.sleep(1)
+                    self.pause(1)
                 last_popup_check = current_time
             
-            pos = self.find_image_in_window(image_path, window_bbox)
+            control_window = None if self.window_registry.is_fallback(target) else dlg
+            pos = self.locate(image_path, control_window, window_bbox)
             if pos:
                 self.log_to_gui(f"Escribiendo texto: '{text_to_type}'")
-                self.click_at_position(pos)
-                time.sleep(0.5)
-                self.click_at_position(pos)
-                time.sleep(0.5)
-                dlg.set_focus()
-                time.sleep(0.3)
-                send_keys(text_to_type, with_spaces=True, pause=0.1)
+                hwnd = None
+                if control_window is not None:
+                    hwnd = self.control_locator.resolved.get((control_window.handle, image_path))
+                strategy = self.text_entry.enter(text_to_type, pos, hwnd, focus_callback=dlg.set_focus)
+                self.frame_grabber.invalidate()
+                if strategy is None:
+                    self.log_to_gui(f"No se pudo verificar el texto '{text_to_type}'")
+                    return False
+                if self.text_entry.last_verified is None:
+                    self.log_to_gui(f"Texto enviado ({strategy}) SIN VERIFICAR: el campo no se pudo leer")
+                else:
+                    self.log_to_gui(f"Texto ingresado ({strategy})")
                 # Verificar popups después de escribir
-                time.sleep(1)
+                self.pause(1)
                 self.check_and_handle_popups()
                 return True
-            time.sleep(1)
+            self.pause(1)
             
         if not self.running:
             return False
             
         self.log_to_gui("Timeout escribiendo texto")
+        self.log_best_match(image_path, start_time)
         return False
 
+    def register_target_windows(self, main_dlg):
+        """Registra las ventanas de Monaco sobre las que trabajan los pasos"""
+        self.window_registry.register(TargetWindow(
+            "main", self.window_var.get(),
+            templates=["Optimize_stage_1.png", "End_stage_1.png", "Mini_Optimize_1_button.png",
+                       "Opt_console_button.png", "Truncate_Stage_2.png", "Segmentation_complete.png",
+                       "Final_dose_calculation.png", "disquete.png"]))
+        self.window_registry.attach("main", main_dlg)
+
+        # Consola de optimización: mientras no esté abierta se busca en la ventana principal
+        self.window_registry.register(TargetWindow(
+            "optconsole", self.optconsole_window_var.get(),
+            templates=["message_filter.png", "End_Stage_2.png", "close_opt_console.png"],
+            fallback="main"))
+
+    @contextmanager
+    def step_span(self, step_name):
+        """Span de traza y métricas de duración y resultado del paso (el cuerpo completa step["success"])"""
+        step = {"name": step_name, "success": False}
+        started = time.time()
+        start = time.perf_counter()
+        self.logger.info(f"Paso iniciado: {step_name}")
+        self.flight_recorder.step = step_name
+        with self.tracer.span(step_name, "paso"):
+            try:
+                yield step
+            finally:
+                duration = time.perf_counter() - start
+                self.metrics.observe("monaco_bot_step_seconds", duration, "Duración de cada paso",
+                                     buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600), step=step_name)
+                self.metrics.inc("monaco_bot_steps_total", help_text="Pasos ejecutados", step=step_name,
+                                 result="ok" if step["success"] else "error")
+                self.run_history.record_step(step_name, started, duration, step["success"],
+                                             self.match_telemetry.summary(started))
+                self.profiler.snapshot(step_name)
+                if not step["success"]:
+                    self.failed_steps.append(step_name)
+                    if self.running:
+                        self.flight_recorder.dump(f"fallo {step_name}")
+                self.logger.info(f"Paso terminado: {step_name} ({'ok' if step['success'] else 'error'}, "
+                                 f"{duration:.1f} s)")
+
     def run_automation(self):
         """Ejecuta la secuencia principal de automatización"""
+        outcome, detail = "detenido", ""
+        profiling = False
         try:
             main_window_string = self.window_var.get()
             timeout = int(self.timeout_var.get())
             popup_images = self.get_popup_image_list()
             
             self.log_to_gui("=== Iniciando automatización ===")
+            self.frame_grabber.capture_count = 0
+            self.control_locator.vision_calls_avoided = 0
+            self.popup_detector.match_attempts = 0
+            self.popup_detector.popups_checked = 0
+            self.current_step = "inicio"
+            if self.trace_var.get():
+                self.tracer.start()
+            self.match_telemetry.clear()
+            self.failed_steps = []
+            self.flight_recorder.enabled = self.flight_recorder_var.get()
+            self.flight_recorder.step = "inicio"
+            self.run_history.begin_run()
+            try:
+                profile_seconds = float(self.profile_seconds_var.get() or 0)
+            except ValueError:
+                profile_seconds = 0.0
+            profile_dir = Path("logs") / f"perfil_{self.run_history.run_id or 0}_{time.strftime('%Y%m%d_%H%M%S')}"
+            profiling = self.profiler.start(self.profile_mode_var.get(), profile_dir, profile_seconds,
+                                            self.profile_memory_var.get())
             if self.popup_detection_var.get():
                 self.log_to_gui(f"Detección de popups ACTIVADA - Imágenes: {popup_images}")
             else:
@@ -728,79 +3847,153 @@ class MonacoBot:
             dlg, bbox = self.get_window_and_bbox(main_window_string)
             if not dlg or not bbox:
                 raise Exception(f"No se pudo conectar con la ventana '{main_window_string}'")
+            self.register_target_windows(dlg)
+            self.select_template_set(bbox)
+            self.scale_calibration.forget()
+            self.ensure_scale_calibrated(bbox)
 
             # Verificación inicial de popups
             self.check_and_handle_popups()
 
-            # Secuencia de automatización
+            # Secuencia de automatización (paso, ventana, trigger, destino)
             steps = [
-                ("Paso 1: Mini Optimize", "Optimize_stage_1.png", "Optimize_stage_1.png"),
-                ("Paso 2: End Stage 1", "End_stage_1.png", "Ok_button.png"),
-                ("Paso 3: Mini Optimize (2)", "Mini_Optimize_1_button.png", "Mini_Optimize_1_button.png"),
-                ("Paso 4: Opt Console", "Opt_console_button.png", "Opt_console_button.png"),
+                ("Paso 1: Mini Optimize", "main", "Optimize_stage_1.png", "Optimize_stage_1.png"),
+                ("Paso 2: End Stage 1", "main", "End_stage_1.png", Hotkey("{ENTER}", "Ok_button.png")),
+                ("Paso 3: Mini Optimize (2)", "main", "Mini_Optimize_1_button.png", "Mini_Optimize_1_button.png"),
+                ("Paso 4: Opt Console", "main", "Opt_console_button.png", "Opt_console_button.png"),
             ]
             
-            for step_name, trigger_img, dest_img in steps:
+            for step_name, target, trigger_img, dest_img in steps:
                 if not self.running:
                     break
                     
                 self.update_status(step_name)
+                self.current_step = step_name
                 self.log_to_gui(f"Ejecutando: {step_name}")
                 
-                success = self.wait_and_click(dlg, bbox, trigger_img, dest_img, timeout)
+                with self.step_span(step_name) as step:
+                    success = step["success"] = self.wait_and_click(target, trigger_img, dest_img, timeout)
                 if not success:
                     self.log_to_gui(f"ERROR en: {step_name}")
                     break
                     
-                time.sleep(1)
+                self.pause(1)
             
             if self.running:
                 # Pasos adicionales
                 self.update_status("Configurando filtro de mensajes")
-                self.wait_and_click(dlg, bbox, "message_filter.png", "message_filter.png", timeout)
-                self.wait_for_image_and_type_text(dlg, bbox, "message_filter.png", "shapes", timeout)
+                self.current_step = "Filtro de mensajes"
+                with self.step_span("Filtro de mensajes") as step:
+                    clicked = self.wait_and_click("optconsole", "message_filter.png", "message_filter.png", timeout)
+                    typed = self.wait_for_image_and_type_text("optconsole", "message_filter.png", "shapes", timeout)
+                    step["success"] = clicked and typed
                 
                 remaining_steps = [
-                    ("End Stage 2", "End_Stage_2.png", "close_opt_console.png"),
-                    ("Truncate Stage 2", "Truncate_Stage_2.png", "Truncate_Stage_2.png"),
-                    ("Segmentation Complete", "Segmentation_complete.png", "Ok_button.png"),
-                    ("Final Dose Calculation", "Final_dose_calculation.png", "disquete.png"),
+                    ("End Stage 2", "optconsole", "End_Stage_2.png", "close_opt_console.png"),
+                    ("Truncate Stage 2", "main", "Truncate_Stage_2.png", "Truncate_Stage_2.png"),
+                    ("Segmentation Complete", "main", "Segmentation_complete.png", Hotkey("{ENTER}", "Ok_button.png")),
+                    ("Final Dose Calculation", "main", "Final_dose_calculation.png",
+                     Hotkey("^s", "disquete.png")),
                 ]
                 
-                for step_name, trigger_img, dest_img in remaining_steps:
+                for step_name, target, trigger_img, dest_img in remaining_steps:
                     if not self.running:
                         break
                         
                     self.update_status(step_name)
-                    success = self.wait_and_click(dlg, bbox, trigger_img, dest_img, timeout)
+                    self.current_step = step_name
+                    with self.step_span(step_name) as step:
+                        success = step["success"] = self.wait_and_click(target, trigger_img, dest_img, timeout)
                     if not success:
                         self.log_to_gui(f"ERROR en: {step_name}")
                         break
-                    time.sleep(1)
+                    self.pause(1)
             
             if self.running:
+                outcome, detail = ("fallo", ", ".join(self.failed_steps)) if self.failed_steps else ("ok", "")
                 self.log_to_gui("=== Automatización completada exitosamente ===")
                 self.update_status("Completado exitosamente")
-                messagebox.showinfo("Éxito", "La automatización se completó exitosamente")
+                self.run_on_gui(lambda: messagebox.showinfo("Éxito", "La automatización se completó exitosamente"))
             else:
                 self.update_status("Automatización detenida")
                 
         except Exception as e:
             error_msg = f"ERROR CRÍTICO: {str(e)}"
+            outcome, detail = "error", str(e)
             self.logger.error(error_msg)
             self.log_to_gui(error_msg)
             self.update_status("Error crítico")
-            messagebox.showerror("Error", f"Error en la automatización:\n{str(e)}")
+            self.flight_recorder.dump("error")
+            self.run_on_gui(lambda: messagebox.showerror("Error", f"Error en la automatización:\n{error_msg}"))
         finally:
+            if profiling:
+                self.save_profile()
+            self.run_history.end_run(outcome, detail)
+            self.log_to_gui(f"Capturas de pantalla realizadas: {self.frame_grabber.capture_count}")
+            if self.tracer.enabled:
+                trace_path = Path("logs") / f"traza_{time.strftime('%Y%m%d_%H%M%S')}.json"
+                try:
+                    events = self.tracer.export(trace_path)
+                    self.log_to_gui(f"Traza guardada: {trace_path} ({events} spans; abrir en ui.perfetto.dev)")
+                except Exception as e:
+                    self.logger.error(f"Error guardando traza: {e}")
+            if self.telemetry_var.get() and self.match_telemetry.count:
+                telemetry_path = Path("logs") / f"telemetria_{time.strftime('%Y%m%d_%H%M%S')}"
+                try:
+                    self.match_telemetry.save_csv(telemetry_path.with_suffix(".csv"))
+                    self.match_telemetry.save_npz(telemetry_path.with_suffix(".npz"))
+                    self.log_to_gui(f"Telemetría guardada: {telemetry_path}.csv/.npz "
+                                    f"({min(self.match_telemetry.count, len(self.match_telemetry.ring))} búsquedas)")
+                except Exception as e:
+                    self.logger.error(f"Error guardando telemetría: {e}")
+            self.layout_model.save()
+            self.scale_calibration.save()
+            self.template_stats.save()
+            if self.popup_detector.popups_checked:
+                self.log_to_gui(f"Búsquedas de imagen por popup: "
+                                f"{self.popup_detector.match_attempts / self.popup_detector.popups_checked:.2f}")
+            self.log_to_gui(f"Búsquedas por imagen evitadas (controles): {self.control_locator.vision_calls_avoided}")
+            self.repeat_filter.flush(self.log_queue_handler)
             self.running = False
-            self.start_button.config(state=tk.NORMAL)
-            self.stop_button.config(state=tk.DISABLED)
-            self.progress.stop()
+            self.run_on_gui(self.reset_controls)
+
+    def save_profile(self):
+        """Cierra el perfilado, lo guarda junto al registro de la corrida y muestra lo más caro"""
+        self.profiler.stop()
+        directory = self.profiler.directory
+        try:
+            self.profiler.save()
+            self.run_history.record_artifact("perfil", directory)
+            self.log_to_gui(f"Perfilado guardado en {directory}")
+        except Exception as e:
+            self.logger.error(f"Error guardando perfilado: {e}")
+        self.log_to_gui("Funciones más costosas (tiempo propio):")
+        for name, own, cumulative, calls in self.profiler.hot_functions(8):
+            self.log_to_gui(f"  {own:8.3f} s  {cumulative:8.3f} s acum.  {name}")
+        if self.profiler.memory:
+            self.log_to_gui("Mayores asignaciones de memoria:")
+            for line, size, count in self.profiler.top_allocators(5):
+                self.log_to_gui(f"  {size / 1024:10.1f} KiB  {count:7d} bloques  {line}")
+
+    def dump_flight_recorder(self):
+        """Botón: vuelca las capturas recientes a disco sin esperar"""
+        directory = self.flight_recorder.dump("pedido")
+        if directory is None:
+            self.log_to_gui("Grabador de vuelo: sin capturas para guardar o volcado en curso")
+        else:
+            self.log_to_gui(f"Grabador de vuelo: guardando {self.flight_recorder.frame_count()} capturas en {directory}")
+
+    def reset_controls(self):
+        """Deja los botones y la barra de progreso en estado de reposo"""
+        self.start_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.DISABLED)
+        self.progress.stop()
 
     def run(self):
         """Ejecuta la aplicación"""
         try:
             self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+            self.root.after(self.gui_poll_ms, self.drain_gui_queue)
             self.root.mainloop()
         except Exception as e:
             self.logger.critical(f"Error crítico en la aplicación: {e}")
@@ -809,8 +4002,59 @@ class MonacoBot:
         """Maneja el cierre de la aplicación"""
         if self.running:
             self.stop_automation()
+        self.geometry_tracker.stop_event_hook()
+        self.metrics_server.stop()
+        self.run_history.stop()
         self.root.quit()
         self.root.destroy()
+        self.stop_logging()
+
+    def register_process_metrics(self):
+        """Métricas calculadas al exportar: CPU del proceso y capturas por segundo"""
+        self.cpu_rate = RateSampler(time.process_time)
+        self.capture_rate = RateSampler(lambda: self.metrics.value("monaco_bot_captures_total"))
+        self.metrics.register_callback("monaco_bot_cpu_seconds_total", "counter", "Tiempo de CPU del proceso",
+                                       time.process_time)
+        self.metrics.register_callback("monaco_bot_cpu_percent", "gauge", "Uso de CPU del proceso (%)",
+                                       lambda: round(self.cpu_rate() * 100, 1))
+        self.metrics.register_callback("monaco_bot_capture_fps", "gauge", "Capturas por segundo",
+                                       lambda: round(self.capture_rate(), 2))
+        self.metrics.register_callback("monaco_bot_flight_recorder_bytes", "gauge",
+                                       "Memoria usada por el grabador de vuelo",
+                                       lambda: self.flight_recorder.total_bytes)
+
+    def metrics_summary(self) -> str:
+        """Resumen legible del registro para el panel de la ventana"""
+        def average_ms(name):
+            count, total = self.metrics.histogram_totals(name)
+            return f"{total / count * 1000:.1f} ms" if count else "-"
+
+        matches, _ = self.metrics.histogram_totals("monaco_bot_match_seconds")
+        return "\n".join([
+            f"Capturas: {self.metrics.value('monaco_bot_captures_total'):.0f}  "
+            f"({self.capture_rate():.2f}/s, {average_ms('monaco_bot_capture_seconds')})",
+            f"Búsquedas de template: {matches}  (promedio {average_ms('monaco_bot_match_seconds')})",
+            f"Barridos de popups: {average_ms('monaco_bot_popup_sweep_seconds')} promedio",
+            f"Clics: {self.metrics.value('monaco_bot_clicks_total'):.0f}",
+            f"CPU: {self.cpu_rate() * 100:.1f}%",
+            f"Endpoint: http://127.0.0.1:{self.metrics_server.port}/metrics"
+            if self.metrics_server.server else "Endpoint: desactivado",
+        ])
+
+    def toggle_metrics_panel(self):
+        """Muestra u oculta el panel de métricas"""
+        self.metrics_panel_visible = not self.metrics_panel_visible
+        if self.metrics_panel_visible:
+            self.metrics_frame.grid()
+            self.refresh_metrics_panel()
+        else:
+            self.metrics_frame.grid_remove()
+
+    def refresh_metrics_panel(self):
+        if not self.metrics_panel_visible:
+            return
+        self.metrics_text_var.set(self.metrics_summary())
+        self.root.after(1000, self.refresh_metrics_panel)
 
     def toggle_debug_window(self):
         """Muestra u oculta la ventana de debugging"""
@@ -848,8 +4092,149 @@ def check_dependencies():
         error_msg += f"\n\nInstala con: pip install {' '.join(missing_deps)}"
         raise ImportError(error_msg)
 
+def run_matcher_benchmark(screenshot_path, images_dir=None, repeat=20):
+    """Compara NCC (OpenCV y FFT en caché) y coincidencia exacta sobre una captura con todos los templates"""
+    images_dir = Path(images_dir) if images_dir else Path(__file__).parent / "images"
+    with Image.open(screenshot_path) as img:
+        screenshot = cv2.cvtColor(np.array(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+    templates = []
+    for template_path in sorted(images_dir.iterdir()):
+        if template_path.suffix.lower() != ".png":
+            continue
+        with Image.open(template_path) as img:
+            template = cv2.cvtColor(np.array(img.convert('RGB')), cv2.COLOR_RGB2BGR)
+        if template.shape[0] <= screenshot.shape[0] and template.shape[1] <= screenshot.shape[1]:
+            templates.append((template_path.name, template))
+
+    engine = TemplateMatchEngine(logging.getLogger(__name__))
+    spectral = SpectralNCC()
+    print(f"Captura: {screenshot_path} {screenshot.shape[1]}x{screenshot.shape[0]}, {repeat} repeticiones")
+    print(f"{'template':32} {'NCC ms':>8} {'exacto ms':>10} {'max |dif| FFT':>14} {'NCC':>12} {'exacto':>12} {'picos':>6}")
+    for name, template in templates:
+        matcher = ExactPixelMatcher(template)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            reference = cv2.matchTemplate(screenshot, template, cv2.TM_CCOEFF_NORMED)
+            ncc_hit = engine.match_ncc(template, screenshot, 0.9)
+        ncc_ms = (time.perf_counter() - start) * 1000 / (2 * repeat)
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            exact_hit = matcher.find(screenshot)
+        exact_ms = (time.perf_counter() - start) * 1000 / repeat
+
+        difference = np.abs(spectral.match(name, template, screenshot, "benchmark") - reference).max()
+        peaks = len(engine.find_all(template, screenshot, 0.9, k=10))
+        ncc_pos = str(ncc_hit[0]) if ncc_hit else "-"
+        print(f"{name:32} {ncc_ms:8.2f} {exact_ms:10.2f} {difference:14.2e} {ncc_pos:>12} "
+              f"{str(exact_hit or '-'):>12} {peaks:>6}")
+
+    # Costo por poll: todos los templates contra el mismo frame
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name, template in templates:
+            cv2.matchTemplate(screenshot, template, cv2.TM_CCOEFF_NORMED)
+    opencv_ms = (time.perf_counter() - start) * 1000 / repeat
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        for name, template in templates:
+            spectral.match(name, template, screenshot, ("poll", i))
+    spectral_ms = (time.perf_counter() - start) * 1000 / repeat
+    print(f"Poll con {len(templates)} templates: OpenCV {opencv_ms:.1f} ms, FFT en caché {spectral_ms:.1f} ms")
+
+
+@contextmanager
+def report_output(name):
+    """Salida de los comandos de reporte. El exe se arma con --windowed y no tiene sys.stdout: se usa
+    la consola desde la que se lo llamó y, si no hay ninguna, un archivo en logs/ que se avisa al final"""
+    if sys.stdout is not None:
+        yield
+        return
+    if sys.platform == 'win32':
+        import ctypes
+        if ctypes.windll.kernel32.AttachConsole(-1):  # ATTACH_PARENT_PROCESS
+            sys.stdout = open("CONOUT$", "w", encoding="utf-8", errors="replace")
+            sys.stderr = sys.stdout
+            try:
+                yield
+            finally:
+                sys.stdout.flush()
+            return
+
+    path = Path("logs") / f"{name}_{time.strftime('%Y%m%d_%H%M%S')}.txt"
+    path.parent.mkdir(exist_ok=True)
+    with open(path, "w", encoding="utf-8") as report:
+        sys.stdout = sys.stderr = report
+        try:
+            yield
+        finally:
+            sys.stdout = sys.stderr = None
+            report.close()
+            root = tk.Tk()
+            root.withdraw()
+            messagebox.showinfo("Monaco Bot", f"Reporte guardado en:\n{path.resolve()}")
+            root.destroy()
+
+
+def parse_args(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Monaco Bot")
+    parser.add_argument("--benchmark-matchers", metavar="CAPTURA",
+                        help="Compara NCC y coincidencia exacta sobre una captura y termina")
+    parser.add_argument("--metrics-port", type=int, default=9464,
+                        help="Puerto local del endpoint de métricas Prometheus (0 lo desactiva)")
+    parser.add_argument("--report", action="store_true",
+                        help="Muestra duración y fallos por paso desde el historial de ejecuciones y termina")
+    parser.add_argument("--weeks", type=int, default=8, help="Semanas a incluir en --report")
+    parser.add_argument("--analyze-log", metavar="LOG", nargs="+",
+                        help="Analiza uno o más monaco_bot.log (errores, repeticiones, templates, pasos) y termina")
+    parser.add_argument("--replay-console", metavar="GRABACION", nargs="?", const="",
+                        help="Pasa una consola grabada (una línea por mensaje) por el detector de fin de etapa "
+                             "y termina; sin archivo verifica el detector con una consola de ejemplo")
+    parser.add_argument("--replay-trigger", default="End_Stage_2.png",
+                        help="Trigger cuyo patrón de consola se usa en --replay-console")
+    parser.add_argument("--replay-history", type=int, default=None,
+                        help="Líneas de la grabación que ya estaban en la consola al empezar la espera")
+    parser.add_argument("--flight-minutes", type=float, default=5.0,
+                        help="Minutos de capturas que guarda el grabador de vuelo")
+    parser.add_argument("--profile", choices=RunProfiler.MODES, default="desactivado",
+                        help="Perfilado del hilo de automatización en cada corrida (cprofile o muestreo)")
+    parser.add_argument("--profile-seconds", type=float, default=0.0,
+                        help="Perfilar solo los primeros N segundos de la corrida (0 = toda)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="Agregar instantáneas de tracemalloc por paso al perfilado (distorsiona los tiempos)")
+    parser.add_argument("--profile-summary", metavar="PERFIL",
+                        help="Muestra las funciones más costosas de un perfil.prof guardado y termina")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
     try:
+        args = parse_args()
+        if args.benchmark_matchers:
+            with report_output("benchmark"):
+                run_matcher_benchmark(args.benchmark_matchers)
+            sys.exit(0)
+        if args.analyze_log:
+            with report_output("analisis_log"):
+                analyze_logs(args.analyze_log)
+            sys.exit(0)
+        if args.report:
+            with report_output("reporte_historial"):
+                run_history_report(weeks=args.weeks)
+            sys.exit(0)
+        if args.profile_summary:
+            with report_output("perfil"):
+                pstats.Stats(args.profile_summary, stream=sys.stdout).sort_stats("tottime").print_stats(25)
+            sys.exit(0)
+        if args.replay_console is not None:
+            with report_output("consola"):
+                ok = replay_console(args.replay_console, args.replay_trigger, args.replay_history)
+            sys.exit(0 if ok else 1)
+
         # Verificar dependencias primero
         check_dependencies()
         
@@ -857,7 +4242,9 @@ if __name__ == "__main__":
         log_dir = Path("logs")
         log_dir.mkdir(exist_ok=True)
         
-        app = MonacoBot()
+        app = MonacoBot(metrics_port=args.metrics_port, flight_minutes=args.flight_minutes,
+                        profile_mode=args.profile, profile_seconds=args.profile_seconds,
+                        profile_memory=args.profile_memory)
         app.run()
     except ImportError as e:
         # Error de dependencias